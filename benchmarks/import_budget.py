@@ -0,0 +1,130 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Import time budget of the scripts.
+
+    python benchmarks/import_budget.py --budget 0.2
+
+The script processor runs every script to read its parameters whenever
+the script lists are refreshed or a script is launched. That phase ends in
+scripts.client(...), so all it pays for is the module level imports. Each
+script is imported in a fresh interpreter, without running it, and the
+time on top of importing omero.scripts is compared to the budget. None of
+HEAVY_MODULES may be imported by then either: they belong after
+scripts.client(...). Exits with 1 if any script is over budget.
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The script_utils package, installed into OMERO_DIST/lib/python
+LIB = os.path.join(ROOT, "lib", "python")
+
+SCRIPTS = [
+    "hcs_scripts/Manage_Plate_Acquisitions.py",
+    "hcs_scripts/Unlink_Images.py",
+    "util_scripts/Change_Channel_Names.py",
+    "util_scripts/Copy_Full_Res_Images.py",
+    "util_scripts/Edit_Object_Attribute.py",
+    "util_scripts/Populate_Metadata.py",
+]
+
+# Modules only needed once the script runs
+HEAVY_MODULES = [
+    "omero.callbacks",
+    "omero.gateway",
+    "omero.util.populate_metadata",
+    "omero.util.populate_roi",
+]
+
+# Seconds a script may add to the import of omero.scripts
+DEFAULT_BUDGET = 0.2
+
+# Run in the child interpreter, printing the import time of the script and
+# the heavy modules it imported
+CHILD = """
+import imp, os, sys, time
+sys.path.insert(0, %(lib)r)
+import omero.scripts
+heavy = %(heavy)r
+already = [name for name in heavy if name in sys.modules]
+started = time.time()
+imp.load_source("budget_" + os.path.basename(%(path)r)[:-3], %(path)r)
+elapsed = time.time() - started
+print elapsed
+print ",".join([name for name in heavy
+                if name in sys.modules and name not in already])
+"""
+
+
+def measure(relative_path, repeat):
+    """
+    Return the best import time of the script over repeat fresh
+    interpreters and the heavy modules it imports.
+    """
+    best = None
+    heavy = []
+    for i in range(repeat):
+        child = CHILD % {
+            "lib": LIB, "heavy": HEAVY_MODULES,
+            "path": os.path.join(ROOT, relative_path)}
+        process = subprocess.Popen(
+            [sys.executable, "-c", child], stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise Exception("Importing %s failed" % relative_path)
+        lines = output.splitlines()
+        seconds = float(lines[-2])
+        heavy = [name for name in lines[-1].split(",") if name]
+        if best is None or seconds < best:
+            best = seconds
+    return best, heavy
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--budget", type="float", default=DEFAULT_BUDGET,
+                      help="Seconds allowed per script [default: %default]")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="Imports per script, the best one counts"
+                      " [default: %default]")
+    options, args = parser.parse_args(argv)
+
+    failed = False
+    print "%-42s %9s  %s" % ("script", "seconds", "heavy modules")
+    for relative_path in SCRIPTS:
+        seconds, heavy = measure(relative_path, options.repeat)
+        status = ""
+        if seconds > options.budget or heavy:
+            status = "  OVER BUDGET"
+            failed = True
+        print "%-42s %9.3f  %s%s" % (
+            relative_path, seconds, ",".join(heavy) or "-", status)
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
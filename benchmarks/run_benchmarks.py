@@ -0,0 +1,269 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Scaling benchmarks of the scripts against the fake services.
+
+    python benchmarks/run_benchmarks.py --sizes 1x96x1,4x384x4 --channels 5
+
+A size is PLATESxWELLSxFIELDS. For Copy_Full_Res_Images it is read as
+source datasets x target datasets x images per target dataset. Every case
+runs in a fresh process, so that the reported peak RSS is its own.
+"""
+
+import imp
+import multiprocessing
+import optparse
+import os
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The script_utils package, installed into OMERO_DIST/lib/python
+LIB = os.path.join(ROOT, "lib", "python")
+sys.path.insert(0, LIB)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeCmdCallback  # noqa
+from fake_services import FakeGateway  # noqa
+from fake_services import SyntheticHierarchy  # noqa
+
+DEFAULT_SIZES = "1x96x1,4x384x4,10x384x9"
+
+# Plates in flight of the asynchronous cases
+PLATES_IN_FLIGHT = 4
+
+
+def load_script(relative_path):
+    """
+    Import a script of the repository as a module.
+    """
+    name = os.path.splitext(os.path.basename(relative_path))[0]
+    return imp.load_source(name, os.path.join(ROOT, relative_path))
+
+
+def use_fake_callback():
+    """
+    Make the scripts wait on the fake delete requests, CmdCallbackI being
+    imported when they submit one.
+    """
+    import omero.callbacks
+    omero.callbacks.CmdCallbackI = FakeCmdCallback
+
+
+def rename_channels(h, plates, wells, fields, channels):
+    screen_id = h.add_screen(plates, wells, fields, channels)
+    module = load_script("util_scripts/Change_Channel_Names.py")
+    script_params = {
+        "Data_Type": "Screen", "IDs": [screen_id],
+        "New_Channel_Names": ["C%d" % c for c in range(channels)]}
+
+    def run():
+        module.renameChannels(FakeGateway(h), script_params).run()
+    return run
+
+
+def copy_images(h, plates, wells, fields, channels):
+    prefixes = ["Slide-%04d" % w for w in range(wells)]
+    project_id, dataset_ids = h.add_project(
+        plates, wells * fields, channels, prefixes)
+    module = load_script("util_scripts/Copy_Full_Res_Images.py")
+    script_params = {
+        "Project_ID": project_id, "IDs": dataset_ids,
+        "Regex_String": r"^(\w+-\w+)-.*"}
+
+    def run():
+        module.copyHighResImages(FakeGateway(h), script_params).run()
+    return run
+
+
+def unlink_images(h, plates, wells, fields, channels):
+    screen_id = h.add_screen(plates, wells, fields, channels)
+    module = load_script("hcs_scripts/Unlink_Images.py")
+    gateway = FakeGateway(h)
+
+    def run():
+        for plate_id in h.screens[screen_id]:
+            module.unlink_plate(
+                gateway.getQueryService(), gateway.getUpdateService(),
+                plate_id, 100)
+    return run
+
+
+def unlink_images_async(h, plates, wells, fields, channels):
+    screen_id = h.add_screen(plates, wells, fields, channels)
+    module = load_script("hcs_scripts/Unlink_Images.py")
+    gateway = FakeGateway(h)
+
+    def run():
+        module.run_operations(
+            [module.unlink_plate_calls(
+                gateway.getQueryService(), gateway.getUpdateService(),
+                plate_id, 100) for plate_id in h.screens[screen_id]],
+            PLATES_IN_FLIGHT)
+    return run
+
+
+def manage_plate_acquisitions(h, plates, wells, fields, channels):
+    screen_id = h.add_screen(plates, wells, fields, channels)
+    module = load_script("hcs_scripts/Manage_Plate_Acquisitions.py")
+    use_fake_callback()
+    gateway = FakeGateway(h)
+
+    def run():
+        query_service = gateway.getQueryService()
+        update_service = gateway.getUpdateService()
+        removed = []
+        for plate_id in h.screens[screen_id]:
+            module.addPlateAcquisition(query_service, update_service,
+                                       plate_id)
+        for plate_id in h.screens[screen_id]:
+            removed.extend(module.unlinkPlateAcquisitions(
+                query_service, update_service, plate_id))
+        module.deletePlateAcquisitions(gateway.c, removed)
+    return run
+
+
+def manage_plate_acquisitions_async(h, plates, wells, fields, channels):
+    screen_id = h.add_screen(plates, wells, fields, channels)
+    module = load_script("hcs_scripts/Manage_Plate_Acquisitions.py")
+    use_fake_callback()
+    gateway = FakeGateway(h)
+
+    def run():
+        query_service = gateway.getQueryService()
+        update_service = gateway.getUpdateService()
+        plate_ids = h.screens[screen_id]
+        module.run_operations(
+            [module.addPlateAcquisitionCalls(
+                query_service, update_service, plate_id)
+             for plate_id in plate_ids], PLATES_IN_FLIGHT)
+        removed = module.run_operations(
+            [module.unlinkPlateAcquisitionsCalls(
+                query_service, update_service, plate_id)
+             for plate_id in plate_ids], PLATES_IN_FLIGHT)
+        module.deletePlateAcquisitions(gateway.c, sum(removed, []))
+    return run
+
+
+def manage_plate_acquisitions_per_field(h, plates, wells, fields,
+                                        channels):
+    screen_id = h.add_screen(plates, wells, fields, channels)
+    module = load_script("hcs_scripts/Manage_Plate_Acquisitions.py")
+    gateway = FakeGateway(h)
+
+    def run():
+        for plate_id in h.screens[screen_id]:
+            module.addPlateAcquisitionsPerGroup(
+                gateway.getQueryService(), gateway.getUpdateService(),
+                plate_id, "Field")
+    return run
+
+
+CASES = [
+    ("Change_Channel_Names", rename_channels),
+    ("Copy_Full_Res_Images", copy_images),
+    ("Unlink_Images", unlink_images),
+    ("Unlink_Images_async", unlink_images_async),
+    ("Manage_Plate_Acquisitions", manage_plate_acquisitions),
+    ("Manage_Plate_Acquisitions_async", manage_plate_acquisitions_async),
+    ("Manage_Plate_Acquisitions_per_field",
+     manage_plate_acquisitions_per_field),
+]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_case(setup, size, channels, verbose, results):
+    """
+    Build the hierarchy and time one case, in a child process.
+    """
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    h = SyntheticHierarchy()
+    run = setup(h, size[0], size[1], size[2], channels)
+    rss_before = peak_rss_mb()
+    h.counters.reset()
+    start = time.time()
+    run()
+    elapsed = time.time() - start
+    results.put({
+        "seconds": elapsed,
+        "rpcs": h.counters.rpcs,
+        "objects": h.counters.objects,
+        "images": len(h.images),
+        "peak_rss": peak_rss_mb(),
+        "rss_growth": peak_rss_mb() - rss_before,
+        "calls": h.counters.calls,
+    })
+
+
+def parse_sizes(sizes):
+    return [tuple(int(n) for n in size.split("x"))
+            for size in sizes.split(",")]
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default=DEFAULT_SIZES,
+                      help="Comma separated PLATESxWELLSxFIELDS sizes"
+                      " [default: %default]")
+    parser.add_option("--channels", type="int", default=5,
+                      help="Channels per image [default: %default]")
+    parser.add_option("--case", action="append", dest="cases",
+                      help="Run only this script, may be repeated")
+    parser.add_option("--calls", action="store_true",
+                      help="Also print the calls per method")
+    parser.add_option("--verbose", action="store_true",
+                      help="Show the output of the scripts")
+    options, args = parser.parse_args(argv)
+
+    print "%-36s %-10s %8s %9s %7s %10s %9s %9s" % (
+        "script", "size", "images", "seconds", "rpcs", "objects",
+        "peak MB", "growth MB")
+    for name, setup in CASES:
+        if options.cases and name not in options.cases:
+            continue
+        for size in parse_sizes(options.sizes):
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_case,
+                args=(setup, size, options.channels, options.verbose,
+                      results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print "%-36s %-10s failed" % (name, "x".join(map(str, size)))
+                continue
+            result = results.get()
+            print "%-36s %-10s %8d %9.2f %7d %10d %9.1f %9.1f" % (
+                name, "x".join(map(str, size)), result["images"],
+                result["seconds"], result["rpcs"], result["objects"],
+                result["peak_rss"], result["rss_growth"])
+            if options.calls:
+                for method in sorted(result["calls"]):
+                    print "    %-24s %d" % (method, result["calls"][method])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
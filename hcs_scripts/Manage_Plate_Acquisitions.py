@@ -22,22 +22,373 @@
 Add or remove PlateAcquisition(s) in a given Plate.
 """
 
+import time
+
 import omero
 import omero.clients
 assert omero
 
-from omero.gateway import BlitzGateway
+from omero.cmd import Delete
+from omero.cmd import DoAll
+from omero.cmd import ERR
 
 from omero.model import PlateAcquisitionI
 from omero.model import PlateI
 
 from omero.rtypes import rlong
 from omero.rtypes import rstring
+from omero.rtypes import rtime
+from omero.rtypes import unwrap
 
 from omero.sys import ParametersI
 
 import omero.scripts as scripts
 
+from script_utils.async_ops import Call
+from script_utils.async_ops import run_operations
+from script_utils.batching import AdaptiveBatchSize
+from script_utils.batching import save_calls
+from script_utils.hierarchy import HierarchyResolver
+from script_utils.paging import chunks
+from script_utils.paging import page_params
+from script_utils.stats import RpcStats
+
+# Number of WellSamples loaded and saved per request
+CHUNK_SIZE = 1000
+
+# Minutes between two acquisition dates starting a new PlateAcquisition
+# when adding one per timestamp
+TIMESTAMP_GAP = 30
+
+# Field index and acquisition date of the WellSamples of Plates
+WELL_SAMPLE_GROUPS_QUERY = (
+    "SELECT ws.id, index(ws), i.acquisitionDate FROM Well AS w "
+    "JOIN w.wellSamples AS ws JOIN ws.image AS i "
+    "WHERE w.plate.id IN (:ids) AND ws.id > :last ORDER BY ws.id")
+
+
+def saveBatchSize(chunkSize=CHUNK_SIZE):
+    """
+    Batch size of the WellSample saves: at most chunkSize, smaller while
+    saves are slow or exceed the message size.
+    """
+    return AdaptiveBatchSize(chunkSize, 10, chunkSize)
+
+
+def addPlateAcquisitionCalls(queryService, updateService, plateId,
+                             chunkSize=CHUNK_SIZE, saveSize=None):
+    """
+    Operation, see script_utils.async_ops, creating a PlateAcquisition in
+    the Plate and assigning all the WellSamples of the Plate to it. The
+    WellSamples are loaded chunkSize at a time and saved in batches of
+    saveSize.
+
+    Its result is the new PlateAcquisition ID and the number of
+    WellSamples.
+    """
+    plateAcquisitionObj = PlateAcquisitionI()
+    plateAcquisitionObj.setPlate(PlateI(plateId, False))
+    plateAcquisitionObj = yield Call(
+        updateService, "saveAndReturnObject", plateAcquisitionObj)
+    plateAcquisitionId = plateAcquisitionObj.getId().getValue()
+    if saveSize is None:
+        saveSize = saveBatchSize(chunkSize)
+
+    count = 0
+    last = 0
+    params = ParametersI()
+    params.addIds([plateId])
+    query = HierarchyResolver(queryService).object_query(
+        "Plate", "WellSample")
+    while True:
+        wellSampleList = yield Call(
+            queryService, "findAllByQuery", query,
+            page_params(params, last, chunkSize))
+        for wellSample in wellSampleList:
+            wellSample.setPlateAcquisition(
+                PlateAcquisitionI(plateAcquisitionId, False))
+        yield save_calls(updateService, wellSampleList, saveSize)
+        count += len(wellSampleList)
+        if len(wellSampleList) < chunkSize:
+            break
+        last = wellSampleList[-1].getId().getValue()
+    yield plateAcquisitionId, count
+
+
+def addPlateAcquisition(queryService, updateService, plateId,
+                        chunkSize=CHUNK_SIZE, saveSize=None):
+    """
+    Create a PlateAcquisition in the Plate and assign all the WellSamples of
+    the Plate to it, see addPlateAcquisitionCalls.
+
+    Returns the new PlateAcquisition ID and the number of WellSamples.
+    """
+    return run_operations([addPlateAcquisitionCalls(
+        queryService, updateService, plateId, chunkSize, saveSize)])[0]
+
+
+def formatDate(date, format="%Y-%m-%d %H:%M:%S"):
+    return time.strftime(format, time.gmtime(date / 1000.0))
+
+
+def groupName(groupBy, key, group):
+    """
+    Name of the PlateAcquisition of a group: its field, or the number and
+    the first and last acquisition dates of its run.
+    """
+    if groupBy == "Field":
+        return "Field %d" % (key + 1)
+    if key is None:
+        return "No acquisition date"
+    start, end = group[1], group[2]
+    if formatDate(start, "%Y-%m-%d") == formatDate(end, "%Y-%m-%d"):
+        return "Run %d: %s - %s" % (
+            key + 1, formatDate(start), formatDate(end, "%H:%M:%S"))
+    return "Run %d: %s - %s" % (key + 1, formatDate(start), formatDate(end))
+
+
+def timestampRuns(dates, timestampGap=TIMESTAMP_GAP):
+    """
+    Split acquisition dates, in milliseconds, into runs: in date order, a
+    date more than timestampGap minutes after the previous one starts a
+    new run. Returns a dictionary of the run index of each date.
+    """
+    runs = {}
+    run = -1
+    previous = None
+    for date in sorted(set(dates)):
+        if previous is None or date - previous > timestampGap * 60000:
+            run += 1
+        runs[date] = run
+        previous = date
+    return runs
+
+
+def addPlateAcquisitionsPerGroupCalls(queryService, updateService, plateId,
+                                      groupBy, chunkSize=CHUNK_SIZE,
+                                      saveSize=None,
+                                      timestampGap=TIMESTAMP_GAP):
+    """
+    Operation, see script_utils.async_ops, creating one PlateAcquisition
+    per field index or per run of acquisition dates in the Plate and
+    assigning each WellSample of the Plate to the one of its group. Runs
+    are split where timestampGap minutes pass without an acquisition, see
+    timestampRuns.
+
+    The groups come from one projection of the (ID, field index,
+    acquisition date) of the WellSamples, paged chunkSize rows at a time.
+    All the PlateAcquisitions are then created with saveAndReturnArray
+    calls, with the first and last acquisition dates of their group as
+    start and end times, and the WellSamples are loaded bare chunkSize at
+    a time and saved in batches of saveSize.
+
+    Its result is a list of (PlateAcquisition ID, name, number of
+    WellSamples) tuples.
+
+    @param groupBy: "Field" or "Timestamp"
+    """
+    params = ParametersI()
+    params.addIds([plateId])
+    wellSampleGroups = {}
+    groups = {}
+    last = 0
+    while True:
+        rows = yield Call(
+            queryService, "projection", WELL_SAMPLE_GROUPS_QUERY,
+            page_params(params, last, chunkSize))
+        for row in rows:
+            wellSampleId, index, date = unwrap(row)
+            if groupBy == "Field":
+                key = index
+            else:
+                key = date
+            wellSampleGroups[wellSampleId] = key
+            if key not in groups:
+                groups[key] = [0, date, date]
+            group = groups[key]
+            group[0] += 1
+            if date is not None:
+                group[1] = min(date, group[1] or date)
+                group[2] = max(date, group[2])
+        if len(rows) < chunkSize:
+            break
+        last = unwrap(rows[-1][0])
+    if groupBy == "Timestamp":
+        runs = timestampRuns(
+            [groupDate for groupDate in groups if groupDate is not None],
+            timestampGap)
+        dateGroups = groups
+        groups = {}
+        for date, dateGroup in dateGroups.items():
+            key = runs.get(date)
+            if key not in groups:
+                groups[key] = [0, date, date]
+            group = groups[key]
+            group[0] += dateGroup[0]
+            if date is not None:
+                group[1] = min(date, group[1])
+                group[2] = max(date, group[2])
+        for wellSampleId, date in wellSampleGroups.items():
+            wellSampleGroups[wellSampleId] = runs.get(date)
+    if not groups:
+        yield []
+        return
+    if saveSize is None:
+        saveSize = saveBatchSize(chunkSize)
+
+    keys = sorted(groups)
+    plateAcquisitionIds = {}
+    for chunk in chunks(keys, chunkSize):
+        plateAcquisitions = []
+        for key in chunk:
+            plateAcquisitionObj = PlateAcquisitionI()
+            plateAcquisitionObj.setPlate(PlateI(plateId, False))
+            plateAcquisitionObj.setName(
+                rstring(groupName(groupBy, key, groups[key])))
+            if groups[key][1] is not None:
+                plateAcquisitionObj.setStartTime(rtime(groups[key][1]))
+                plateAcquisitionObj.setEndTime(rtime(groups[key][2]))
+            plateAcquisitions.append(plateAcquisitionObj)
+        plateAcquisitions = yield Call(
+            updateService, "saveAndReturnArray", plateAcquisitions)
+        for key, plateAcquisitionObj in zip(chunk, plateAcquisitions):
+            plateAcquisitionIds[key] = plateAcquisitionObj.getId().getValue()
+
+    last = 0
+    query = HierarchyResolver(queryService).object_query(
+        "Plate", "WellSample")
+    while True:
+        wellSampleList = yield Call(
+            queryService, "findAllByQuery", query,
+            page_params(params, last, chunkSize))
+        toSave = []
+        for wellSample in wellSampleList:
+            wellSampleId = wellSample.getId().getValue()
+            if wellSampleId not in wellSampleGroups:
+                # Added since the projection
+                continue
+            wellSample.setPlateAcquisition(PlateAcquisitionI(
+                plateAcquisitionIds[wellSampleGroups[wellSampleId]], False))
+            toSave.append(wellSample)
+        yield save_calls(updateService, toSave, saveSize)
+        if len(wellSampleList) < chunkSize:
+            break
+        last = wellSampleList[-1].getId().getValue()
+    yield [(plateAcquisitionIds[key], groupName(groupBy, key, groups[key]),
+            groups[key][0]) for key in keys]
+
+
+def addPlateAcquisitionsPerGroup(queryService, updateService, plateId,
+                                 groupBy, chunkSize=CHUNK_SIZE,
+                                 saveSize=None, timestampGap=TIMESTAMP_GAP):
+    """
+    Create one PlateAcquisition per field index or per run of acquisition
+    dates in the Plate, see addPlateAcquisitionsPerGroupCalls.
+
+    Returns a list of (PlateAcquisition ID, name, number of WellSamples)
+    tuples.
+    """
+    return run_operations([addPlateAcquisitionsPerGroupCalls(
+        queryService, updateService, plateId, groupBy, chunkSize,
+        saveSize, timestampGap)])[0]
+
+
+def unlinkPlateAcquisitionsCalls(queryService, updateService, plateId,
+                                 chunkSize=CHUNK_SIZE, ctx=None,
+                                 saveSize=None):
+    """
+    Operation, see script_utils.async_ops, unsetting the PlateAcquisition
+    of every WellSample of the Plate which has one. Every WellSample is
+    loaded and saved once, chunkSize at a time and in batches of saveSize.
+
+    Its result is the list of the IDs of the PlateAcquisitions of the
+    Plate.
+    """
+    params = ParametersI()
+    params.addId(plateId)
+    rows = yield Call(
+        queryService, "projection",
+        "SELECT pa.id FROM PlateAcquisition AS pa "
+        "WHERE pa.plate.id = :id", params, ctx=ctx)
+    plateAcquisitionIds = [row[0].getValue() for row in rows]
+    if not plateAcquisitionIds:
+        yield plateAcquisitionIds
+        return
+    if saveSize is None:
+        saveSize = saveBatchSize(chunkSize)
+
+    count = 0
+    last = 0
+    params = ParametersI()
+    params.addIds([plateId])
+    query = HierarchyResolver(queryService).object_query(
+        "Plate", "WellSample", "ws.plateAcquisition is not null")
+    while True:
+        wellSampleList = yield Call(
+            queryService, "findAllByQuery", query,
+            page_params(params, last, chunkSize), ctx=ctx)
+        for wellSample in wellSampleList:
+            wellSample.setPlateAcquisition(None)
+        yield save_calls(updateService, wellSampleList, saveSize, ctx)
+        count += len(wellSampleList)
+        print "Plate %d: unlinked %d WellSample(s)" % (plateId, count)
+        if len(wellSampleList) < chunkSize:
+            break
+        last = wellSampleList[-1].getId().getValue()
+    yield plateAcquisitionIds
+
+
+def unlinkPlateAcquisitions(queryService, updateService, plateId,
+                            chunkSize=CHUNK_SIZE, ctx=None, saveSize=None):
+    """
+    Unset the PlateAcquisition of every WellSample of the Plate which has
+    one, see unlinkPlateAcquisitionsCalls.
+
+    Returns the IDs of the PlateAcquisitions of the Plate.
+    """
+    return run_operations([unlinkPlateAcquisitionsCalls(
+        queryService, updateService, plateId, chunkSize, ctx, saveSize)])[0]
+
+
+def findMissingPlates(queryService, plateIds, ctx=None):
+    """
+    Return the IDs from plateIds of which there is no Plate, checking all
+    of them with one query.
+    """
+    params = ParametersI()
+    params.addIds(plateIds)
+    rows = queryService.projection(
+        "SELECT p.id FROM Plate AS p WHERE p.id IN (:ids)", params, ctx)
+    found = set(row[0].getValue() for row in rows)
+    return [plateId for plateId in plateIds if plateId not in found]
+
+
+def deletePlateAcquisitions(client, plateAcquisitionIds, ms=500):
+    """
+    Delete all the PlateAcquisitions with one DoAll request, printing the
+    progress every ms milliseconds until it completes.
+    """
+    if not plateAcquisitionIds:
+        return
+    from omero.callbacks import CmdCallbackI
+    requests = [Delete("/PlateAcquisition", plateAcquisitionId, None)
+                for plateAcquisitionId in plateAcquisitionIds]
+    handle = client.getSession().submit(DoAll(requests, None))
+    callback = CmdCallbackI(client, handle)
+    try:
+        while not callback.block(ms):
+            status = handle.getStatus()
+            print "Deleting PlateAcquisitions: step %d of %d" % (
+                status.currentStep, status.steps)
+        response = callback.getResponse()
+        if isinstance(response, ERR):
+            raise Exception(
+                "Deleting PlateAcquisitions failed: %s %s" %
+                (response.category, response.name))
+        print "Deleted %d PlateAcquisition(s)" % len(plateAcquisitionIds)
+    finally:
+        callback.close(True)
+
 
 def run():
     """
@@ -57,11 +408,32 @@ def run():
                      description="List of Plate IDs").ofType(rlong(0)),
 
         scripts.String("Mode", optional=False, grouping="3",
-                       description="Select if you want to add or "
-                                   "remove PlateAcquisitions",
-                       values=[rstring("Add"), rstring("Remove")],
+                       description="Select if you want to add one "
+                                   "PlateAcquisition for all the "
+                                   "WellSamples, one per field or one per "
+                                   "run of acquisition dates, or to remove "
+                                   "PlateAcquisitions",
+                       values=[rstring("Add"), rstring("Add per Field"),
+                               rstring("Add per Timestamp"),
+                               rstring("Remove")],
                        default="Add"),
 
+        scripts.Bool("Collect_Stats", grouping="4", default=False,
+                     description="Report the server calls made in a Stats"
+                                 " output"),
+
+        scripts.Int("Plates_In_Flight", grouping="5",
+                    description="Number of Plates processed concurrently"
+                                " with asynchronous calls, with 1 they are"
+                                " processed one after the other",
+                    default=1, min=1, max=32),
+
+        scripts.Int("Timestamp_Gap", grouping="6",
+                    description="Add per Timestamp: minutes without an"
+                                " acquisition starting a new"
+                                " PlateAcquisition",
+                    default=TIMESTAMP_GAP, min=0),
+
         version="0.2",
         authors=["Niko Klaric"],
         institutions=["Glencoe Software Inc."],
@@ -74,72 +446,75 @@ def run():
             if client.getInput(key):
                 scriptParams[key] = client.getInput(key, unwrap=True)
 
+        from omero.gateway import BlitzGateway
         connection = BlitzGateway(client_obj=client)
         updateService = connection.getUpdateService()
         queryService = connection.getQueryService()
+        stats = None
+        if scriptParams.get("Collect_Stats"):
+            stats = RpcStats()
+            updateService = stats.wrap(updateService, "update")
+            queryService = stats.wrap(queryService, "query")
 
         processedMessages = []
 
-        for plateId in scriptParams["IDs"]:
-            plateObj = connection.getObject("Plate", plateId)
-            if plateObj is None:
-                client.setOutput(
-                    "Message",
-                    rstring("ERROR: No Plate with ID %s" % plateId))
-                return
-
-            if scriptParams["Mode"] == "Add":
-                plateAcquisitionObj = PlateAcquisitionI()
-                plateAcquisitionObj.setPlate(PlateI(plateObj.getId(), False))
-
-                wellGrid = plateObj.getWellGrid()
-                for axis in wellGrid:
-                    for wellObj in axis:
-                        wellSampleList = wellObj.copyWellSamples()
-                        plateAcquisitionObj.addAllWellSampleSet(wellSampleList)
-
-                plateAcquisitionObj = updateService.saveAndReturnObject(
-                    plateAcquisitionObj)
-                plateAcquisitionId = plateAcquisitionObj.getId()._val
-
+        plateIds = scriptParams["IDs"]
+        missingIds = findMissingPlates(
+            queryService, plateIds, connection.SERVICE_OPTS)
+        if missingIds:
+            client.setOutput(
+                "Message",
+                rstring("ERROR: No Plate with ID %s" % missingIds[0]))
+            return
+
+        removedIds = []
+        saveSize = saveBatchSize()
+        inFlight = scriptParams.get("Plates_In_Flight", 1)
+        if scriptParams["Mode"] == "Add":
+            results = run_operations(
+                [addPlateAcquisitionCalls(
+                    queryService, updateService, plateId,
+                    saveSize=saveSize) for plateId in plateIds],
+                inFlight)
+            for plateId, result in zip(plateIds, results):
                 processedMessages.append(
                     "Linked new PlateAcquisition with ID %d"
-                    " to Plate with ID %d." % (plateAcquisitionId, plateId))
-            else:
-                params = ParametersI()
-                params.addId(plateId)
-
-                queryString = """
-                    FROM PlateAcquisition AS pa
-                    LEFT JOIN FETCH pa.wellSample
-                    LEFT OUTER JOIN FETCH pa.annotationLinks
-                        WHERE pa.plate.id = :id
-                    """
-                plateAcquisitionList = queryService.findAllByQuery(
-                    queryString, params, connection.SERVICE_OPTS)
-                if plateAcquisitionList:
-                    updateList = []
-
-                    for plate_acquisition in plateAcquisitionList:
-                        for well_sample in plate_acquisition.copyWellSample():
-                            well_sample.setPlateAcquisition(None)
-                            updateList.append(well_sample)
-
-                        updateService.saveArray(updateList)
-
-                        plate_acquisition.clearWellSample()
-                        plate_acquisition.clearAnnotationLinks()
-
-                        plate_acquisition = updateService.saveAndReturnObject(
-                            plate_acquisition)
-                        updateService.deleteObject(plate_acquisition)
-
+                    " to Plate with ID %d (%d WellSample(s))." %
+                    (result[0], plateId, result[1]))
+        elif scriptParams["Mode"] in ("Add per Field", "Add per Timestamp"):
+            groupBy = scriptParams["Mode"][len("Add per "):]
+            timestampGap = scriptParams.get("Timestamp_Gap", TIMESTAMP_GAP)
+            results = run_operations(
+                [addPlateAcquisitionsPerGroupCalls(
+                    queryService, updateService, plateId, groupBy,
+                    saveSize=saveSize, timestampGap=timestampGap)
+                 for plateId in plateIds],
+                inFlight)
+            for plateId, result in zip(plateIds, results):
+                processedMessages.append(
+                    "Linked %d new PlateAcquisition(s) to Plate with ID %d"
+                    " (%d WellSample(s))." %
+                    (len(result), plateId,
+                     sum([count for paId, name, count in result])))
+        else:
+            results = run_operations(
+                [unlinkPlateAcquisitionsCalls(
+                    queryService, updateService, plateId,
+                    ctx=connection.SERVICE_OPTS, saveSize=saveSize)
+                 for plateId in plateIds],
+                inFlight)
+            for plateId, plateAcquisitionIds in zip(plateIds, results):
+                removedIds.extend(plateAcquisitionIds)
                 processedMessages.append(
                     "%d PlateAcquisition(s) removed from Plate with ID %d." %
-                    (len(plateAcquisitionList), plateId))
+                    (len(plateAcquisitionIds), plateId))
+
+        deletePlateAcquisitions(client, removedIds)
 
         client.setOutput("Message", rstring("No errors. %s" %
                          " ".join(processedMessages)))
+        if stats is not None:
+            client.setOutput("Stats", rstring(stats.summary()))
     finally:
         client.closeSession()
 
@@ -33,6 +33,66 @@ from omero.sys import ParametersI
 
 import omero.scripts as scripts
 
+from script_utils.async_ops import Call
+from script_utils.async_ops import run_operations
+from script_utils.batching import AdaptiveBatchSize
+from script_utils.batching import save_calls
+from script_utils.hierarchy import HierarchyResolver
+from script_utils.paging import page_params
+from script_utils.stats import RpcStats
+
+
+def unlink_plate_calls(query_service, update_service, plate_id, chunk_size):
+    """
+    Operation, see script_utils.async_ops, unlinking the Images of all the
+    Wells of a Plate. Well IDs are paged in ID order and only chunk_size
+    Wells with their WellSamples are loaded per request. They are saved in
+    batches of at most chunk_size, smaller while saves are slow or exceed
+    the message size.
+
+    Its result is the number of WellSamples removed.
+    """
+    count = 0
+    save_size = AdaptiveBatchSize(chunk_size, 1, chunk_size)
+    well_id_query = HierarchyResolver(query_service).query("Plate", "Well")
+    plate_params = ParametersI()
+    plate_params.addIds([plate_id])
+    last = 0
+    while True:
+        rows = yield Call(
+            query_service, "projection", well_id_query,
+            page_params(plate_params, last, chunk_size))
+        well_ids = [row[0].getValue() for row in rows]
+        if not well_ids:
+            break
+        well_params = ParametersI()
+        well_params.addIds(well_ids)
+        wells = yield Call(
+            query_service, "findAllByQuery",
+            "SELECT DISTINCT w FROM Well AS w "
+            "LEFT JOIN FETCH w.wellSamples AS ws "
+            "WHERE w.id IN (:ids)", well_params)
+        for well in wells:
+            count += well.sizeOfWellSamples()
+            well.clearWellSamples()
+        yield save_calls(update_service, wells, save_size)
+        print "Plate %d: %d Well(s) processed, %d Image(s) unlinked" % (
+            plate_id, len(well_ids), count)
+        if len(well_ids) < chunk_size:
+            break
+        last = well_ids[-1]
+    yield count
+
+
+def unlink_plate(query_service, update_service, plate_id, chunk_size):
+    """
+    Unlink the Images of all the Wells of a Plate, see unlink_plate_calls.
+
+    Returns the number of WellSamples removed.
+    """
+    return run_operations([unlink_plate_calls(
+        query_service, update_service, plate_id, chunk_size)])[0]
+
 
 def run():
     """
@@ -51,6 +111,20 @@ def run():
         scripts.List("IDs", optional=False, grouping="2",
                      description="List of Plate IDs").ofType(rlong(0)),
 
+        scripts.Int("Chunk_Size", optional=False, grouping="3",
+                    description="Number of Wells processed per request",
+                    default=100, min=1),
+
+        scripts.Bool("Collect_Stats", grouping="4", default=False,
+                     description="Report the server calls made in a Stats"
+                                 " output"),
+
+        scripts.Int("Plates_In_Flight", grouping="5",
+                    description="Number of Plates processed concurrently"
+                                " with asynchronous calls, with 1 they are"
+                                " processed one after the other",
+                    default=1, min=1, max=32),
+
         version="0.1",
         authors=["Chris Allan"],
         institutions=["Glencoe Software Inc."],
@@ -66,23 +140,22 @@ def run():
         session = client.getSession()
         update_service = session.getUpdateService()
         query_service = session.getQueryService()
-
-        count = 0
-        for plate_id in script_params["IDs"]:
-            params = ParametersI()
-            params.addId(plate_id)
-            plate = query_service.findByQuery(
-                "SELECT p from Plate AS p "
-                "LEFT JOIN FETCH p.wells as w "
-                "LEFT JOIN FETCH w.wellSamples as ws "
-                "WHERE p.id = :id", params)
-            for well in plate.copyWells():
-                count += well.sizeOfWellSamples()
-                well.clearWellSamples()
-            update_service.saveObject(plate)
+        stats = None
+        if script_params.get("Collect_Stats"):
+            stats = RpcStats()
+            update_service = stats.wrap(update_service, "update")
+            query_service = stats.wrap(query_service, "query")
+
+        count = sum(run_operations(
+            [unlink_plate_calls(query_service, update_service, plate_id,
+                                script_params["Chunk_Size"])
+             for plate_id in script_params["IDs"]],
+            script_params.get("Plates_In_Flight", 1)))
 
         client.setOutput("Message", rstring(
             "Unlinking of %d Image(s) successful." % count))
+        if stats is not None:
+            client.setOutput("Stats", rstring(stats.summary()))
     finally:
         client.closeSession()
 
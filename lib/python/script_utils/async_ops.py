@@ -0,0 +1,214 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Operations overlapping their server calls over one session.
+
+An operation is a generator yielding a Call for every server call it
+makes. The result of the call is sent back into the generator, or its
+exception raised there. A yielded generator runs as a nested operation
+whose result is sent back the same way, and any other value yielded is
+the result of the operation:
+
+    def unlink(plate_id):
+        wells = yield Call(query_service, "findAllByQuery", query, params)
+        ...
+        yield save_calls(update_service, wells, batch_size)
+        yield len(wells)
+
+    counts = run_operations([unlink(p) for p in plate_ids], in_flight=8)
+
+run_sync makes the calls one after the other. run_async keeps up to
+in_flight operations going, each with its call in flight as an Ice
+asynchronous invocation (begin_/end_), so that many operations are
+limited by the throughput of the server rather than by round trips.
+Everything runs in the calling thread.
+"""
+
+import sys
+import time
+import types
+from collections import deque
+
+
+class Call(object):
+    """
+    One server call: service.method(*args), with an optional call
+    context given as ctx. Once made, seconds is the time from its begin_ to
+    its end_, or the time of the blocking call, not counting the time
+    spent waiting for other operations.
+    """
+
+    def __init__(self, service, method, *args, **kwargs):
+        self.service = service
+        self.method = method
+        self.args = args
+        self.ctx = kwargs.get("ctx")
+        self.started = None
+        self.seconds = None
+
+    def invoke(self):
+        self.started = time.time()
+        try:
+            return getattr(self.service, self.method)(
+                *(self.args + (self.ctx,)))
+        finally:
+            self.seconds = time.time() - self.started
+
+    def begin(self):
+        begin = getattr(self.service, "begin_" + self.method)
+        self.started = time.time()
+        if self.ctx is None:
+            return begin(*self.args)
+        return begin(*self.args, _ctx=self.ctx)
+
+    def end(self, async_result):
+        try:
+            return getattr(self.service, "end_" + self.method)(async_result)
+        finally:
+            self.seconds = time.time() - self.started
+
+
+class _Operation(object):
+    """
+    Stack of the generators of one operation, advanced from call to call.
+    """
+
+    def __init__(self, generator):
+        # [generator, result] per level
+        self.stack = [[generator, None]]
+        self.result = None
+
+    def advance(self, value=None, error=None):
+        """
+        Resume the operation with the result or the exc_info of its last
+        call. Returns its next Call, None once it has finished.
+        """
+        while self.stack:
+            frame = self.stack[-1]
+            try:
+                if error is not None:
+                    step = frame[0].throw(*error)
+                else:
+                    step = frame[0].send(value)
+            except StopIteration:
+                self.stack.pop()
+                value, error = frame[1], None
+                continue
+            except Exception:
+                self.stack.pop()
+                if not self.stack:
+                    raise
+                value, error = None, sys.exc_info()
+                continue
+            value, error = None, None
+            if isinstance(step, Call):
+                return step
+            if isinstance(step, types.GeneratorType):
+                self.stack.append([step, None])
+            else:
+                frame[1] = step
+        self.result = value
+        return None
+
+
+def run_sync(operations):
+    """
+    Run the operations one after the other, with blocking calls.
+    Returns their results, in order.
+    """
+    results = []
+    for generator in operations:
+        operation = _Operation(generator)
+        call = operation.advance()
+        while call is not None:
+            try:
+                value, error = call.invoke(), None
+            except Exception:
+                value, error = None, sys.exc_info()
+            call = operation.advance(value, error)
+        results.append(operation.result)
+    return results
+
+
+def run_async(operations, in_flight):
+    """
+    Run up to in_flight operations at a time with asynchronous calls.
+    Returns their results, in order. After an operation fails no other one
+    is started, those already running are completed and the first error
+    is raised.
+    """
+    operations = iter(enumerate(operations))
+    results = {}
+    pending = deque()
+    failure = []
+
+    def advance(index, operation, value=None, error=None):
+        while True:
+            try:
+                call = operation.advance(value, error)
+            except Exception:
+                if not failure:
+                    failure.append(sys.exc_info())
+                return
+            if call is None:
+                results[index] = operation.result
+                return
+            try:
+                pending.append((index, operation, call, call.begin()))
+                return
+            except Exception:
+                value, error = None, sys.exc_info()
+
+    while True:
+        while not failure and len(pending) < in_flight:
+            try:
+                index, generator = operations.next()
+            except StopIteration:
+                break
+            advance(index, _Operation(generator))
+        if not pending:
+            break
+        # Prefer any completed call, otherwise wait for the oldest one
+        for item in pending:
+            if item[3].isCompleted():
+                pending.remove(item)
+                break
+        else:
+            item = pending.popleft()
+        index, operation, call, async_result = item
+        try:
+            value, error = call.end(async_result), None
+        except Exception:
+            value, error = None, sys.exc_info()
+        advance(index, operation, value, error)
+    if failure:
+        raise failure[0][0], failure[0][1], failure[0][2]
+    return [results[key] for key in sorted(results)]
+
+
+def run_operations(operations, in_flight=1):
+    """
+    Run the operations with run_async when in_flight is above 1, with
+    run_sync otherwise.
+    """
+    if in_flight > 1:
+        return run_async(operations, in_flight)
+    return run_sync(operations)
@@ -0,0 +1,194 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Batch sizing for bulk reads and writes.
+
+AdaptiveBatchSize measures every batch and steers the size so that a round
+trip takes about target_seconds: large enough to amortise the per call
+latency, small enough to stay clear of Ice timeouts and message size
+limits. Reads failing with a timeout or a message size error are retried
+at half the size. Writes are retried only after a message size error
+raised on the client, when the request was never sent: after a timeout
+the server may well have committed it. FixedBatchSize has the same
+interface for callers which want a constant size, plain integers are
+converted to it.
+"""
+
+import time
+
+import Ice
+
+from script_utils.async_ops import Call, run_sync
+from script_utils.stats import approx_size
+
+
+def is_retryable(error, idempotent=True):
+    """
+    True for the errors caused by a batch being too large: Ice timeouts and
+    message size limits, on either side of the connection. For calls which
+    are not idempotent, e.g. saves, only the client side message size
+    limit, as the request may have been processed otherwise.
+    """
+    if isinstance(error, Ice.MemoryLimitException):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(error, Ice.TimeoutException):
+        return True
+    if isinstance(error, Ice.UnknownLocalException):
+        return "MemoryLimitException" in str(error.unknown)
+    return False
+
+
+class FixedBatchSize(object):
+    """
+    Constant batch size, never retried.
+    """
+
+    def __init__(self, size):
+        self.size = int(size)
+        self.minimum = self.size
+
+    def record(self, count, seconds, nbytes=None):
+        pass
+
+    def retry(self, error, count, idempotent=True):
+        return False
+
+
+class AdaptiveBatchSize(object):
+    """
+    Batch size kept between minimum and maximum, changed by at most a factor
+    of two per batch towards the size which would take target_seconds and
+    stay under max_bytes. It never grows back to the size of a batch which
+    failed.
+    """
+
+    def __init__(self, initial=100, minimum=1, maximum=10000,
+                 target_seconds=1.0, max_bytes=None):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.limit = maximum
+
+    def _set(self, size):
+        self.size = int(max(self.minimum, min(self.limit, size)))
+
+    def record(self, count, seconds, nbytes=None):
+        """
+        Adjust the size after a successful batch of count items which took
+        seconds and, optionally, moved nbytes.
+        """
+        if count == 0:
+            return
+        if seconds > 0:
+            ideal = count * self.target_seconds / seconds
+        else:
+            ideal = self.maximum
+        if self.max_bytes and nbytes:
+            ideal = min(ideal, count * self.max_bytes / float(nbytes))
+        if count < self.size and ideal > self.size:
+            # A short, final batch says little about larger ones
+            return
+        self._set(min(max(ideal, self.size / 2.0), self.size * 2))
+
+    def retry(self, error, count, idempotent=True):
+        """
+        Halve the size after a batch of count items failed with error.
+        Returns True if the batch should be retried at the new size, see
+        is_retryable.
+        """
+        if not is_retryable(error, idempotent) or count <= self.minimum:
+            return False
+        self.limit = max(self.minimum, min(self.limit, count - 1))
+        self._set(min(self.size, count) / 2)
+        print "Batch of %d failed (%s), retrying with %d" % (
+            count, error.__class__.__name__, self.size)
+        return True
+
+
+def as_batch_size(batch_size):
+    """
+    Return batch_size as an object with the FixedBatchSize interface.
+    """
+    if isinstance(batch_size, (int, long)):
+        return FixedBatchSize(batch_size)
+    return batch_size
+
+
+def run_in_batches(function, items, batch_size):
+    """
+    Call function with consecutive batches of items, each batch sized by
+    batch_size at the time it is taken, and yield (batch, result) pairs.
+    Batches failing with a retryable error are split further, so function
+    must be idempotent, e.g. a read.
+    """
+    batch_size = as_batch_size(batch_size)
+    items = list(items)
+    start = 0
+    while start < len(items):
+        batch = items[start:start + batch_size.size]
+        started = time.time()
+        try:
+            result = function(batch)
+        except Exception as e:
+            if batch_size.retry(e, len(batch)):
+                continue
+            raise
+        batch_size.record(len(batch), time.time() - started)
+        start += len(batch)
+        yield batch, result
+
+
+def save_calls(update_service, objects, batch_size, ctx=None):
+    """
+    Operation, see script_utils.async_ops, saveArray-ing objects in batches
+    sized by batch_size. The payload size is measured too when batch_size
+    has a max_bytes limit. A batch is retried smaller only if it was never
+    sent, see is_retryable. Batches are timed by their own call, so waiting
+    on other operations under run_async does not shrink them.
+    """
+    batch_size = as_batch_size(batch_size)
+    objects = list(objects)
+    start = 0
+    while start < len(objects):
+        batch = objects[start:start + batch_size.size]
+        call = Call(update_service, "saveArray", batch, ctx=ctx)
+        try:
+            yield call
+        except Exception as e:
+            if batch_size.retry(e, len(batch), idempotent=False):
+                continue
+            raise
+        nbytes = None
+        if getattr(batch_size, "max_bytes", None):
+            nbytes = approx_size(batch)[1]
+        batch_size.record(len(batch), call.seconds, nbytes)
+        start += len(batch)
+
+
+def save_in_batches(update_service, objects, batch_size, ctx=None):
+    """
+    saveArray objects in batches sized by batch_size, see save_calls.
+    """
+    run_sync([save_calls(update_service, objects, batch_size, ctx)])
@@ -0,0 +1,290 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Checkpoint journals of long running scripts.
+
+A journal records the ranges of IDs a script has completed, keyed by a
+hash of the parameters of the run, so that a rerun with the same
+parameters can continue where the previous one stopped:
+
+    journal = CheckpointJournal(
+        LocalFileStore(CheckpointJournal.key_for(params)))
+    last = journal.resume_point()
+    for ids in iter_projection(..., start=last):
+        ...
+        journal.add(last + 1, ids[-1])
+        journal.save()
+        last = ids[-1]
+    journal.clear()
+
+The journal is kept either in a local file of the script server or in a
+FileAnnotation attached to the object the script runs on.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import omero
+import omero.model
+from omero.cmd import Delete, ERR
+from omero.rtypes import rlong, rstring
+
+# Namespace of the FileAnnotations holding journals
+NSCHECKPOINT = "openmicroscopy.org/omero/user_scripts/checkpoint"
+
+# Directory of the local journal files
+LOCAL_DIR = os.path.join(tempfile.gettempdir(), "omero_script_checkpoints")
+
+# Seconds after which a local journal is stale: a rerun starts over and
+# the file is removed
+LOCAL_MAX_AGE = 24 * 60 * 60
+
+
+class LocalFileStore(object):
+    """
+    Journal kept in a file of the script server. Journals not written for
+    max_age seconds are expired, those of interrupted runs which were never
+    rerun included, so that a stale journal does not skip the IDs created
+    since below its resume point.
+    """
+
+    def __init__(self, key, directory=LOCAL_DIR, max_age=LOCAL_MAX_AGE):
+        self.path = os.path.join(directory, "%s.json" % key)
+        self.max_age = max_age
+
+    def expire(self):
+        """
+        Remove the journals of the directory older than max_age.
+        """
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            return
+        oldest = time.time() - self.max_age
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def read(self):
+        self.expire()
+        if not os.path.exists(self.path):
+            return None
+        f = open(self.path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def write(self, text):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = self.path + ".tmp"
+        f = open(temp_path, "w")
+        try:
+            f.write(text)
+        finally:
+            f.close()
+        os.rename(temp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class FileAnnotationStore(object):
+    """
+    Journal kept in a FileAnnotation linked to an object, e.g. the Screen
+    being processed.
+    """
+
+    def __init__(self, conn, object_type, object_id, key):
+        self.conn = conn
+        self.object_type = object_type
+        self.object_id = object_id
+        self.name = "%s.json" % key
+        self.annotation_id = None
+        self.file_id = None
+
+    def find(self):
+        params = omero.sys.ParametersI()
+        params.addId(self.object_id)
+        params.add("ns", rstring(NSCHECKPOINT))
+        params.add("name", rstring(self.name))
+        annotation = self.conn.getQueryService().findByQuery(
+            "select a from %sAnnotationLink as l"
+            " join l.child as a join fetch a.file as f"
+            " where l.parent.id = :id and a.ns = :ns and f.name = :name"
+            % self.object_type, params)
+        if annotation is not None:
+            self.annotation_id = annotation.getId().getValue()
+            self.file_id = annotation.getFile().getId().getValue()
+        return self.file_id
+
+    def create(self):
+        update_service = self.conn.getUpdateService()
+        original_file = omero.model.OriginalFileI()
+        original_file.setName(rstring(self.name))
+        original_file.setPath(rstring(NSCHECKPOINT))
+        original_file.setMimetype(rstring("application/json"))
+        original_file.setSize(rlong(0))
+        original_file = update_service.saveAndReturnObject(original_file)
+        self.file_id = original_file.getId().getValue()
+
+        annotation = omero.model.FileAnnotationI()
+        annotation.setNs(rstring(NSCHECKPOINT))
+        annotation.setFile(omero.model.OriginalFileI(self.file_id, False))
+        link = getattr(omero.model, "%sAnnotationLinkI" % self.object_type)()
+        link.setParent(getattr(omero.model, "%sI" % self.object_type)(
+            self.object_id, False))
+        link.setChild(annotation)
+        link = update_service.saveAndReturnObject(link)
+        self.annotation_id = link.getChild().getId().getValue()
+
+    def read(self):
+        if self.file_id is None and self.find() is None:
+            return None
+        store = self.conn.createRawFileStore()
+        try:
+            store.setFileId(self.file_id)
+            return store.read(0, store.size())
+        finally:
+            store.close()
+
+    def write(self, text):
+        if self.file_id is None and self.find() is None:
+            self.create()
+        store = self.conn.createRawFileStore()
+        try:
+            store.setFileId(self.file_id)
+            store.write(text, 0, len(text))
+            store.truncate(len(text))
+            store.save()
+        finally:
+            store.close()
+
+    def clear(self, ms=500):
+        """
+        Delete the FileAnnotation, its links and its OriginalFile.
+        """
+        if self.annotation_id is None and self.find() is None:
+            return
+        from omero.callbacks import CmdCallbackI
+        client = self.conn.c
+        handle = client.getSession().submit(
+            Delete("/Annotation", self.annotation_id, None))
+        callback = CmdCallbackI(client, handle)
+        try:
+            while not callback.block(ms):
+                pass
+            response = callback.getResponse()
+            if isinstance(response, ERR):
+                raise Exception(
+                    "Deleting the checkpoint journal failed: %s %s" %
+                    (response.category, response.name))
+        finally:
+            callback.close(True)
+        self.annotation_id = None
+        self.file_id = None
+
+
+class CheckpointJournal(object):
+    """
+    Sorted, merged lists of completed [first, last] ID ranges, saved to
+    its store at most every interval seconds unless forced. Ranges are
+    kept per scope, e.g. per Plate when Well IDs are journalled, so that
+    the IDs of other scopes falling between them are not covered.
+    """
+
+    def __init__(self, store, interval=10):
+        self.store = store
+        self.interval = interval
+        self.ranges = {}
+        self.saved = 0
+        self.changed = False
+        text = store.read()
+        if text:
+            for scope, ranges in json.loads(text)["ranges"].items():
+                self.ranges[scope] = [tuple(r) for r in ranges]
+
+    @staticmethod
+    def key_for(*values):
+        """
+        Hash identifying a run by its parameters.
+        """
+        return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()
+
+    def add(self, first, last, scope=None):
+        """
+        Record the IDs from first to last, inclusive, as completed.
+        """
+        merged = []
+        for start, end in self.ranges.get(str(scope), []):
+            if end + 1 < first or last + 1 < start:
+                merged.append((start, end))
+            else:
+                first = min(first, start)
+                last = max(last, end)
+        merged.append((first, last))
+        merged.sort()
+        self.ranges[str(scope)] = merged
+        self.changed = True
+
+    def contains(self, object_id, scope=None):
+        for start, end in self.ranges.get(str(scope), []):
+            if start <= object_id <= end:
+                return True
+            if object_id < start:
+                break
+        return False
+
+    def resume_point(self, scope=None):
+        """
+        Last ID of the completed range starting at the first ID, 0 if none,
+        i.e. the key a keyset iteration can continue after.
+        """
+        ranges = self.ranges.get(str(scope), [])
+        if ranges and ranges[0][0] <= 1:
+            return ranges[0][1]
+        return 0
+
+    def save(self, force=False):
+        if not self.changed:
+            return
+        if not force and time.time() - self.saved < self.interval:
+            return
+        self.store.write(json.dumps({"ranges": self.ranges}))
+        self.saved = time.time()
+        self.changed = False
+
+    def clear(self):
+        """
+        Forget the journal, once the run has completed.
+        """
+        self.ranges = {}
+        self.changed = False
+        self.store.clear()
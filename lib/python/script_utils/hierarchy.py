@@ -0,0 +1,207 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Expansion of containers to their descendants.
+
+    resolver = HierarchyResolver(conn.getQueryService())
+    for lc_ids in resolver.iter_ids("Screen", [1], "LogicalChannel"):
+        ...
+
+The HQL is generated from the path between the two levels, one entity per
+step of the path joined on IDs, and paged with script_utils.paging:
+
+    select distinct c.logicalChannel.id
+      from ScreenPlateLink as spl, Well as w, WellSample as ws,
+           Pixels as pix join pix.channels as c
+     where spl.parent.id in (:ids) and w.plate.id = spl.child.id
+       and ws.well.id = w.id and pix.image.id = ws.image.id
+       and c.logicalChannel.id > :last
+     order by c.logicalChannel.id
+
+Extra conditions and columns may refer to the aliases of the steps, see
+STEPS. Expansions are not cached: the script server starts a new process
+for every script it runs, and linking children to a container does not
+change its update event, so a cache could neither outlive one run nor
+tell when it is stale.
+"""
+
+import omero
+
+from script_utils.paging import DEFAULT_CHUNK_SIZE
+from script_utils.paging import iter_objects, iter_projection
+
+# (parent, child) -> (entities, alias, parent ID, child ID) of one step.
+# Channels are joined from their Pixels, so that index(c) can be used.
+STEPS = {
+    ("Screen", "Plate"): (
+        "ScreenPlateLink as spl", "spl", "spl.parent.id", "spl.child.id"),
+    ("Plate", "Well"): ("Well as w", "w", "w.plate.id", "w.id"),
+    ("Well", "WellSample"): (
+        "WellSample as ws", "ws", "ws.well.id", "ws.id"),
+    ("Well", "Image"): (
+        "WellSample as ws", "ws", "ws.well.id", "ws.image.id"),
+    ("Project", "Dataset"): (
+        "ProjectDatasetLink as pdl", "pdl", "pdl.parent.id",
+        "pdl.child.id"),
+    ("Dataset", "Image"): (
+        "DatasetImageLink as dil", "dil", "dil.parent.id", "dil.child.id"),
+    ("Image", "LogicalChannel"): (
+        "Pixels as pix join pix.channels as c", "c", "pix.image.id",
+        "c.logicalChannel.id"),
+}
+
+
+def find_path(source, target):
+    """
+    Return the steps leading from source down to target, e.g. from
+    "Screen" to "Image", or None if target is not below source.
+    """
+    if source == target:
+        return None
+    paths = [[source]]
+    while paths:
+        path = paths.pop(0)
+        for parent, child in sorted(STEPS):
+            if parent != path[-1]:
+                continue
+            if child == target:
+                return [STEPS[(a, b)]
+                        for a, b in zip(path, path[1:] + [child])]
+            paths.append(path + [child])
+    return None
+
+
+class HierarchyResolver(object):
+    """
+    Generates and runs the paged projections expanding containers to their
+    descendants.
+    """
+
+    def __init__(self, query_service, ctx=None):
+        self.query_service = query_service
+        self.ctx = ctx
+
+    def supports(self, source, target):
+        return find_path(source, target) is not None
+
+    def _path(self, source, target):
+        path = find_path(source, target)
+        if path is None:
+            raise ValueError("No %s below %s" % (target, source))
+        return path
+
+    def _query(self, path, select, extra_where):
+        key = path[-1][3]
+        conditions = ["%s in (:ids)" % path[0][2]]
+        for previous, step in zip(path, path[1:]):
+            conditions.append("%s = %s" % (step[2], previous[3]))
+        if extra_where:
+            conditions.append(extra_where)
+        conditions.append("%s > :last" % key)
+        return "select distinct %s from %s where %s order by %s" % (
+            select,
+            ", ".join([step[0] for step in path]),
+            " and ".join(conditions), key)
+
+    def query(self, source, target, columns=None, extra_where=None):
+        """
+        Keyset paged HQL selecting the IDs of the target descendants of
+        the source containers given as :ids, followed by columns, ordered
+        by the target ID.
+        @param columns: additional expressions to select
+        @param extra_where: additional condition
+        """
+        path = self._path(source, target)
+        return self._query(
+            path, ", ".join([path[-1][3]] + list(columns or [])),
+            extra_where)
+
+    def object_query(self, source, target, extra_where=None):
+        """
+        Like query but selecting the target objects themselves. Only for
+        targets whose step entity is the target, e.g. Well or WellSample.
+        """
+        path = self._path(source, target)
+        alias = path[-1][1]
+        if path[-1][3] != alias + ".id":
+            raise ValueError("No %s objects below %s" % (target, source))
+        return self._query(path, alias, extra_where)
+
+    def _params(self, ids, params):
+        page_params = omero.sys.ParametersI()
+        if params is not None:
+            page_params = omero.sys.ParametersI(dict(params.map))
+        page_params.addIds(ids)
+        return page_params
+
+    def iter_rows(self, source, ids, target, columns=None, extra_where=None,
+                  params=None, chunk_size=DEFAULT_CHUNK_SIZE, start=0):
+        """
+        Iterate over pages of [target ID] + columns rows of the target
+        descendants of the source containers, in target ID order. The
+        target ID must be unique in the rows for the paging to be exact.
+
+        @param source: type of the containers, e.g. "Screen"
+        @param ids: IDs of the containers
+        @param target: type of the descendants, e.g. "Image"
+        @param columns: additional expressions to select
+        @param extra_where: additional condition, using the aliases of
+                            STEPS and parameters from params
+        @param params: ParametersI with the parameters of extra_where
+        @param chunk_size: rows per page, or a batch size
+        @param start: target ID to continue after
+        """
+        return iter_projection(
+            self.query_service,
+            self.query(source, target, columns, extra_where),
+            self._params(ids, params), chunk_size, ctx=self.ctx, start=start)
+
+    def iter_ids(self, source, ids, target, extra_where=None, params=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, start=0):
+        """
+        Iterate over pages of the IDs of the target descendants of the
+        source containers, see iter_rows.
+        """
+        for rows in self.iter_rows(
+                source, ids, target, None, extra_where, params, chunk_size,
+                start):
+            yield [row[0] for row in rows]
+
+    def ids(self, source, ids, target, extra_where=None, params=None):
+        """
+        All the IDs of the target descendants of the source containers.
+        """
+        result = []
+        for page in self.iter_ids(source, ids, target, extra_where, params):
+            result.extend(page)
+        return result
+
+    def iter_objects(self, source, ids, target, extra_where=None,
+                     params=None, chunk_size=DEFAULT_CHUNK_SIZE, start=0):
+        """
+        Iterate over pages of the target descendants themselves, see
+        object_query.
+        """
+        return iter_objects(
+            self.query_service,
+            self.object_query(source, target, extra_where),
+            self._params(ids, params), chunk_size, ctx=self.ctx,
+            start=start)
@@ -0,0 +1,106 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Compact sets of object IDs.
+
+An IdSet keeps its IDs in a sorted array of 64 bit integers, 8 bytes per
+ID instead of the ~70 of an int in a Python set, with binary search
+membership. IDs added in ascending order, the usual case when walking
+keyset paged results, are appended directly; others wait in a small
+Python set which is merged into the array once it grows.
+"""
+
+import heapq
+from array import array
+from bisect import bisect_left
+
+# Largest number of IDs waiting to be merged into the array
+PENDING_MAX = 65536
+
+
+def _typecode():
+    for typecode in ("q", "l"):
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    # Doubles hold integers exactly up to 2 ** 53
+    return "d"
+
+
+TYPECODE = _typecode()
+
+
+class IdSet(object):
+    """
+    Set of integer IDs backed by a sorted array.
+    """
+
+    def __init__(self, ids=None):
+        self.ids = array(TYPECODE)
+        self.pending = set()
+        if ids is not None:
+            self.update(ids)
+
+    def _in_array(self, object_id):
+        index = bisect_left(self.ids, object_id)
+        return index < len(self.ids) and self.ids[index] == object_id
+
+    def __contains__(self, object_id):
+        return object_id in self.pending or self._in_array(object_id)
+
+    def __len__(self):
+        return len(self.ids) + len(self.pending)
+
+    def __iter__(self):
+        self.compact()
+        for object_id in self.ids:
+            yield long(object_id)
+
+    def add(self, object_id):
+        if not self.pending and (not self.ids or object_id > self.ids[-1]):
+            self.ids.append(object_id)
+        elif object_id not in self:
+            self.pending.add(object_id)
+            if len(self.pending) >= PENDING_MAX:
+                self.compact()
+
+    def update(self, ids):
+        for object_id in ids:
+            self.add(object_id)
+
+    def compact(self):
+        """
+        Merge the pending IDs into the array.
+        """
+        if not self.pending:
+            return
+        merged = array(TYPECODE)
+        merged.extend(heapq.merge(self.ids, sorted(self.pending)))
+        self.ids = merged
+        self.pending = set()
+
+    def missing(self, ids):
+        """
+        The IDs from ids which are not in the set, in their order.
+        """
+        return [object_id for object_id in ids if object_id not in self]
@@ -0,0 +1,205 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Keyset paging over IQuery results.
+
+The queries passed to iter_projection and iter_objects must restrict their
+key to "> :last" and be ordered by it, e.g.
+
+    select ws.id from WellSample as ws
+     where ws.well.plate.id = :id and ws.id > :last
+     order by ws.id
+
+Every page is then a cheap index range scan on the server, however deep
+into the result the iteration is, and the next page is fetched in the
+background while the current one is processed.
+
+chunk_size may be an integer or a batch size from script_utils.batching,
+an AdaptiveBatchSize then sizes every page from the timing of the
+previous ones.
+"""
+
+import sys
+import threading
+import time
+
+import omero
+from omero.rtypes import rlong, unwrap
+
+from script_utils.batching import as_batch_size
+
+# Rows or objects per page
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _fetch_measured(fetch_page, last, batch_size):
+    """
+    Fetch one page sized by batch_size, recording its timing and retrying
+    smaller pages after a timeout. Returns the page and the limit used.
+    """
+    while True:
+        limit = batch_size.size
+        started = time.time()
+        try:
+            page = fetch_page(last, limit)
+        except Exception as e:
+            if batch_size.retry(e, limit):
+                continue
+            raise
+        batch_size.record(len(page), time.time() - started)
+        return page, limit
+
+
+class _Fetch(threading.Thread):
+    """
+    Runs one page fetch in the background.
+    """
+
+    def __init__(self, fetch_page, last, batch_size):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.fetch_page = fetch_page
+        self.last = last
+        self.batch_size = batch_size
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = _fetch_measured(
+                self.fetch_page, self.last, self.batch_size)
+        except BaseException:
+            self.error = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+def _iter_keyset(fetch_page, key, chunk_size, prefetch, start):
+    batch_size = as_batch_size(chunk_size)
+    last = start
+    pending = None
+    while True:
+        if pending is not None:
+            page, limit = pending.get()
+        else:
+            page, limit = _fetch_measured(fetch_page, last, batch_size)
+        if not page:
+            return
+        if len(page) < limit:
+            yield page
+            return
+        last = key(page[-1])
+        pending = None
+        if prefetch:
+            pending = _Fetch(fetch_page, last, batch_size)
+            pending.start()
+        yield page
+
+
+def _params_for(params):
+    if params is None:
+        return omero.sys.ParametersI()
+    return params
+
+
+def page_params(params, last, limit):
+    """
+    Copy of params for the page of at most limit results after the key
+    last, e.g. for operations making their own keyset paged calls.
+    """
+    page = omero.sys.ParametersI(dict(_params_for(params).map))
+    page.add("last", rlong(last))
+    page.page(0, limit)
+    return page
+
+
+def iter_projection(query_service, query, params=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, key_index=0, ctx=None,
+                    prefetch=True, start=0):
+    """
+    Iterate over the pages of a keyset paged projection. Yields lists of
+    rows, every row being a list of unwrapped values.
+
+    @param query_service: IQuery proxy
+    @param query: HQL with an "> :last" restriction on its key column
+    @param params: ParametersI, its "last" parameter and page are
+                   overwritten
+    @param chunk_size: maximum number of rows per page, or a batch size
+    @param key_index: index of the key column in the rows
+    @param ctx: call context
+    @param prefetch: fetch the next page while the current one is consumed
+    @param start: key to continue after, e.g. when resuming
+    """
+    params = _params_for(params)
+
+    def fetch_page(last, limit):
+        rows = query_service.projection(
+            query, page_params(params, last, limit), ctx)
+        return [[unwrap(value) for value in row] for row in rows]
+
+    return _iter_keyset(
+        fetch_page, lambda row: row[key_index], chunk_size, prefetch, start)
+
+
+def iter_objects(query_service, query, params=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, ctx=None, prefetch=True,
+                 start=0):
+    """
+    Iterate over the pages of a keyset paged findAllByQuery keyed by the
+    object ID. Yields lists of model objects.
+
+    @param query_service: IQuery proxy
+    @param query: HQL selecting objects with an "id > :last" restriction
+    @param params: ParametersI, its "last" parameter and page are
+                   overwritten
+    @param chunk_size: maximum number of objects per page, or a batch
+                       size
+    @param ctx: call context
+    @param prefetch: fetch the next page while the current one is consumed
+    @param start: object ID to continue after, e.g. when resuming
+    """
+    params = _params_for(params)
+
+    def fetch_page(last, limit):
+        return query_service.findAllByQuery(
+            query, page_params(params, last, limit), ctx)
+
+    return _iter_keyset(
+        fetch_page, lambda obj: obj.getId().getValue(), chunk_size, prefetch,
+        start)
+
+
+def chunks(sequence, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split a sequence, e.g. a list of IDs, into lists of at most chunk_size
+    items. A batch size is read again for every list.
+    """
+    batch_size = as_batch_size(chunk_size)
+    sequence = list(sequence)
+    start = 0
+    while start < len(sequence):
+        chunk = sequence[start:start + batch_size.size]
+        start += len(chunk)
+        yield chunk
@@ -0,0 +1,250 @@
+# coding=utf-8
+"""
+-----------------------------------------------------------------------------
+  Copyright (C) 2015 Glencoe Software, Inc. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Opt-in RPC instrumentation of OMERO services.
+
+    stats = RpcStats()
+    query_service = stats.wrap(conn.getQueryService(), "query")
+    ...
+    client.setOutput("Stats", rstring(stats.summary()))
+
+Every call made through a wrapped service is counted per method with a
+latency histogram and the number of objects and approximate bytes sent
+and received.
+"""
+
+import threading
+import time
+
+import omero
+import omero.model
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                   10000)
+
+
+def approx_size(value, seen=None, nested=False):
+    """
+    Estimate the number of objects and of bytes in the arguments or the
+    result of a call. Model objects and projection rows (lists within a
+    list) count as objects, tuples such as argument lists are transparent.
+    Bytes are the sizes of the strings plus 8 per number or reference.
+
+    Returns a (objects, bytes) tuple.
+    """
+    if seen is None:
+        seen = set()
+    if value is None:
+        return 0, 0
+    if isinstance(value, basestring):
+        return 0, len(value)
+    if isinstance(value, (bool, int, long, float)):
+        return 0, 8
+    if id(value) in seen:
+        return 0, 8
+    seen.add(id(value))
+    objects = 0
+    size = 8
+    if isinstance(value, omero.RType):
+        inner = approx_size(value.getValue(), seen, nested)
+        return inner[0], inner[1]
+    if isinstance(value, omero.model.IObject):
+        objects = 1
+        values = value.__dict__.values()
+    elif isinstance(value, dict):
+        values = value.values()
+    elif isinstance(value, tuple):
+        values = value
+    elif isinstance(value, list):
+        if nested:
+            objects = 1
+        values = value
+        nested = True
+    elif hasattr(value, "__dict__"):
+        values = value.__dict__.values()
+    else:
+        return 0, 8
+    for item in values:
+        item_objects, item_size = approx_size(item, seen, nested)
+        objects += item_objects
+        size += item_size
+    return objects, size
+
+
+class MethodStats(object):
+    """
+    Counters of one method of one service.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.objects_sent = 0
+        self.bytes_sent = 0
+        self.objects_received = 0
+        self.bytes_received = 0
+
+    def record(self, seconds, sent, received, error):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.seconds += seconds
+        ms = seconds * 1000
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and ms > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+        self.objects_sent += sent[0]
+        self.bytes_sent += sent[1]
+        self.objects_received += received[0]
+        self.bytes_received += received[1]
+
+
+class RpcStats(object):
+    """
+    Collects the statistics of all the services wrapped with it. Safe to
+    share between threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.started = time.time()
+
+    def wrap(self, service, name):
+        """
+        Return service instrumented under name, e.g. "query".
+        """
+        return InstrumentedService(service, self, name)
+
+    def record(self, method, seconds, sent, received, error=False):
+        self.lock.acquire()
+        try:
+            if method not in self.methods:
+                self.methods[method] = MethodStats()
+            self.methods[method].record(seconds, sent, received, error)
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        """
+        Human readable summary, one block per method, slowest first.
+        """
+        lines = []
+        total_calls = 0
+        total_seconds = 0.0
+        methods = sorted(self.methods.items(),
+                         key=lambda item: -item[1].seconds)
+        for method, stats in methods:
+            total_calls += stats.calls
+            total_seconds += stats.seconds
+            lines.append(
+                "%s: %d calls (%d failed), %.2f s, %.1f ms/call,"
+                " sent %d objects/%s, received %d objects/%s" % (
+                    method, stats.calls, stats.errors, stats.seconds,
+                    stats.seconds * 1000 / stats.calls,
+                    stats.objects_sent, format_bytes(stats.bytes_sent),
+                    stats.objects_received,
+                    format_bytes(stats.bytes_received)))
+            buckets = []
+            for bucket, count in enumerate(stats.histogram):
+                if count == 0:
+                    continue
+                if bucket < len(LATENCY_BUCKETS):
+                    label = "<=%dms" % LATENCY_BUCKETS[bucket]
+                else:
+                    label = ">%dms" % LATENCY_BUCKETS[-1]
+                buckets.append("%s: %d" % (label, count))
+            lines.append("    " + ", ".join(buckets))
+        lines.insert(0, "%d calls, %.2f s in calls, %.2f s elapsed" % (
+            total_calls, total_seconds, time.time() - self.started))
+        return "\n".join(lines)
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f GB" % size
+
+
+class InstrumentedService(object):
+    """
+    Proxy recording every method call of the wrapped service in an
+    RpcStats. Asynchronous calls are recorded from their begin_ to their
+    end_ under the name of the method. Ice methods are passed through
+    unchanged.
+    """
+
+    def __init__(self, service, stats, name):
+        self._service = service
+        self._stats = stats
+        self._name = name
+        # id(AsyncResult) -> (start, sent) of the calls in flight
+        self._begun = {}
+
+    def __getattr__(self, attr):
+        method = getattr(self._service, attr)
+        if not callable(method) or attr.startswith("ice_"):
+            return method
+        stats = self._stats
+        begun = self._begun
+        if attr.startswith("begin_"):
+            def begin(*args, **kwargs):
+                sent = approx_size(args)
+                start = time.time()
+                async_result = method(*args, **kwargs)
+                begun[id(async_result)] = (start, sent)
+                return async_result
+            return begin
+        if attr.startswith("end_"):
+            name = "%s.%s" % (self._name, attr[len("end_"):])
+
+            def end(async_result):
+                start, sent = begun.pop(id(async_result))
+                try:
+                    result = method(async_result)
+                except Exception:
+                    stats.record(
+                        name, time.time() - start, sent, (0, 0), True)
+                    raise
+                stats.record(
+                    name, time.time() - start, sent, approx_size(result))
+                return result
+            return end
+        name = "%s.%s" % (self._name, attr)
+
+        def call(*args, **kwargs):
+            sent = approx_size(args)
+            start = time.time()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                stats.record(name, time.time() - start, sent, (0, 0), True)
+                raise
+            elapsed = time.time() - start
+            stats.record(name, elapsed, sent, approx_size(result))
+            return result
+        return call
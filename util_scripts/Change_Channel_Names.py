@@ -21,11 +21,122 @@
 """
 
 import omero
-from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, rlong
+from omero.rtypes import rint, rstring, rlong, unwrap
 import omero.scripts as scripts
+from script_utils.batching import AdaptiveBatchSize
+from script_utils.batching import run_in_batches, save_in_batches
+from script_utils.checkpoint import CheckpointJournal
+from script_utils.checkpoint import FileAnnotationStore, LocalFileStore
+from script_utils.hierarchy import HierarchyResolver
+from script_utils.idset import IdSet
+from script_utils.stats import RpcStats
 
-import random
+import Queue
+import threading
+
+
+class pipelinedWriter:
+
+    def __init__(self, client, concurrency, stats=None):
+        """
+        Pool of writer threads saving batches of objects concurrently.
+        Every writer saves through its own session joined to the session
+        of client. At most 2 * concurrency batches are queued, so the
+        reader can run ahead of the writers only by that much. Each writer
+        splits the batches it takes by its own AdaptiveBatchSize.
+        @param client: omero.client whose session the writers join
+        @param concurrency: number of writer threads
+        @param stats: optional RpcStats recording the writer calls
+        """
+        self.stats = stats
+        self.queue = Queue.Queue(2 * concurrency)
+        self.errors = []
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.saved = 0
+        self.finished = set()
+        self.threads = []
+        for i in range(concurrency):
+            writer_client = client.createClient(client.isSecure())
+            thread = threading.Thread(
+                target=self.work, args=(writer_client,))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self, writer_client):
+        """
+        Save the queued batches until None is taken. After any error,
+        including one setting up the session, the remaining batches are
+        only drained so that put() never blocks and check() raises it.
+        """
+        try:
+            try:
+                update_service = \
+                    writer_client.getSession().getUpdateService()
+                if self.stats is not None:
+                    update_service = self.stats.wrap(
+                        update_service, "update")
+            except Exception as e:
+                self.errors.append(e)
+            batch_size = AdaptiveBatchSize(500, 10, 5000)
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if len(self.errors) > 0:
+                    continue
+                sequence, batch = item
+                try:
+                    save_in_batches(update_service, batch, batch_size)
+                except Exception as e:
+                    self.errors.append(e)
+                    continue
+                self.markSaved(sequence)
+        finally:
+            try:
+                writer_client.closeSession()
+            except Exception:
+                pass
+
+    def markSaved(self, sequence):
+        self.lock.acquire()
+        try:
+            self.finished.add(sequence)
+            while self.saved + 1 in self.finished:
+                self.saved += 1
+                self.finished.remove(self.saved)
+        finally:
+            self.lock.release()
+
+    def put(self, batch):
+        """
+        Queue a batch for saving, blocking while the queue is full.
+        Returns the sequence number of the batch.
+        """
+        self.check()
+        self.submitted += 1
+        self.queue.put((self.submitted, batch))
+        return self.submitted
+
+    def savedThrough(self):
+        """
+        Sequence number up to which all the batches have been saved.
+        """
+        return self.saved
+
+    def close(self):
+        """
+        Wait for all the queued batches to be saved.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def check(self):
+        if len(self.errors) > 0:
+            raise self.errors[0]
 
 
 class renameChannels:
@@ -39,96 +150,195 @@ class renameChannels:
         @param scriptParams: scipt parameters.
         """
         self.conn = conn
-        self.lc_paging = 100
-        self.image_paging = 100
+        self.lc_paging = AdaptiveBatchSize(100, 10, 5000)
+        self.image_paging = AdaptiveBatchSize(100, 10, 2000)
+        self.save_paging = AdaptiveBatchSize(500, 10, 5000)
+        self.well_paging = 100
         self.data_type = scriptParams["Data_Type"]
         self.ids = scriptParams["IDs"]
         self.new_channel_names = scriptParams["New_Channel_Names"]
-        self.image_id_list = []
+        self.rename_mode = scriptParams.get("Rename_Mode", "Projection")
+        self.concurrency = scriptParams.get("Concurrency", 1)
+        self.writer = None
+        self.checkpoint_mode = scriptParams.get("Checkpoint", "None")
+        self.checkpoint = None
+        self.pending_pages = []
+        self.done_lc_ids = IdSet()
+        self.done_image_ids = IdSet()
+        self.processed_images = 0
         self.query_service = self.conn.getQueryService()
         self.update_service = self.conn.getUpdateService()
+        self.stats = None
+        if scriptParams.get("Collect_Stats"):
+            self.stats = RpcStats()
+            self.query_service = self.stats.wrap(self.query_service, "query")
+            self.update_service = self.stats.wrap(
+                self.update_service, "update")
+        self.image_ids_query = \
+            "select distinct i.id from Image i" \
+            " join i.pixels as p" \
+            " join p.channels as c" \
+            " join c.logicalChannel as lc" \
+            " where lc.id in (:ids)"
         self.get_image_query = \
-            "select i from Image i" \
+            "select distinct i from Image i" \
             " left outer join fetch i.pixels as p" \
             " left outer join fetch p.channels as c" \
             " join fetch c.logicalChannel as lc" \
-            " where lc.id in (:ids)"
-        self.well_query = "select distinct lc.id" \
-            " from Well as w" \
-            " join w.wellSamples as ws" \
-            " join ws.image as i" \
-            " join i.pixels as pixels" \
-            " join pixels.channels as c" \
-            " join c.logicalChannel as lc" \
-            " where w.id in (:ids)"
-        self.plate_query = "select distinct lc.id" \
-            " from Plate as p" \
-            " join p.wells as w" \
-            " join w.wellSamples as ws" \
-            " join ws.image as i" \
-            " join i.pixels as pixels" \
-            " join pixels.channels as c" \
-            " join c.logicalChannel as lc" \
-            " where p.id in (:ids)"
-        self.screen_query = \
-            "select distinct lc.id" \
-            " from Screen as s" \
-            " join s.plateLinks as p_link" \
-            " join p_link.child as p" \
-            " join p.wells as w" \
-            " join w.wellSamples as ws" \
-            " join ws.image as i" \
-            " join i.pixels as pixels" \
-            " join pixels.channels as c" \
-            " join c.logicalChannel as lc" \
-            " where s.id in (:ids)"
-        self.dataset_query = \
-            "select distinct lc.id" \
-            " from Dataset as d" \
-            " join d.imageLinks as dil" \
-            " join dil.child as i" \
-            " join i.pixels as pixels" \
-            " join pixels.channels as c" \
-            " join c.logicalChannel as lc" \
-            " where d.id in (:ids)"
-        self.project_query = \
-            "select distinct lc.id" \
-            " from Project p" \
-            " join p.datasetLinks as links" \
-            " join links.child as dataset" \
-            " join dataset.imageLinks as dil" \
-            " join dil.child as i" \
-            " join i.pixels as pixels" \
-            " join pixels.channels as c" \
-            " join c.logicalChannel as lc" \
-            " where p.id in (:ids)"
-        self.image_query = \
-            "select distinct lc.id" \
+            " where i.id in (:ids)"
+        self.channel_query = \
+            "select i.id, lc.id, index(c), pixels.sizeC, lc.name" \
             " from Image as i" \
             " join i.pixels as pixels" \
             " join pixels.channels as c" \
             " join c.logicalChannel as lc" \
             " where i.id in (:ids)"
+        self.get_lc_query = \
+            "select lc from LogicalChannel as lc where lc.id in (:ids)"
+        self.resolver = HierarchyResolver(self.query_service)
+
+    def iterLcIdPages(self, start=0):
+        """
+        Iterate over the logical channel IDs below the objects to rename
+        in ascending order, one page of self.lc_paging IDs at a time. The
+        page size adapts to the time the pages take. Only the candidates
+        of candidateFilter are returned.
+        @param start: logical channel ID to continue after
+        """
+        extra_where, params = self.candidateFilter()
+        return self.resolver.iter_ids(
+            self.data_type, self.ids, "LogicalChannel", extra_where, params,
+            chunk_size=self.lc_paging, start=start)
+
+    def iterWellIdPages(self, plate_id, start=0):
+        """
+        Iterate over the well IDs of a plate in ascending order, one page
+        of self.well_paging IDs at a time.
+        @param start: well ID to continue after
+        """
+        return self.resolver.iter_ids(
+            "Plate", [plate_id], "Well", chunk_size=self.well_paging,
+            start=start)
 
-    def getLcIdsList(self, query):
+    def getPlateIds(self):
+        if self.data_type == "Plate":
+            return sorted(set(self.ids))
+        return self.resolver.ids(self.data_type, self.ids, "Plate")
+
+    def candidateFilter(self):
+        """
+        Condition and parameters selecting, on the server, only the logical
+        channels of images with as many channels as new names and whose
+        name differs from the new name for their index. Reruns then only
+        see what is left to do and images with another number of channels
+        are skipped without being read.
+        """
         params = omero.sys.ParametersI()
-        params.addIds(self.ids)
-        lc_ids = self.query_service.projection(query, params)
-        if len(lc_ids) == 0:
+        params.add("size_c", rint(len(self.new_channel_names)))
+        clauses = []
+        for index, name in enumerate(self.new_channel_names):
+            params.add("name%i" % index, rstring(name))
+            clauses.append(
+                "(index(c) = %i and (c.logicalChannel.name is null"
+                " or c.logicalChannel.name <> :name%i))" % (index, index))
+        return "pix.sizeC = :size_c and (%s)" % " or ".join(clauses), params
+
+    def openCheckpoint(self):
+        """
+        Open the journal of the logical channel ID ranges completed by
+        previous runs with the same parameters, if enabled.
+        """
+        if self.checkpoint_mode == "None":
             return None
-        lc_ids = [lc_id[0] for lc_id in lc_ids]
-        return [lc_id.getValue() for lc_id in lc_ids]
+        key = CheckpointJournal.key_for(
+            "Change_Channel_Names", self.data_type, sorted(self.ids),
+            self.new_channel_names)
+        if self.checkpoint_mode == "File Annotation":
+            store = FileAnnotationStore(
+                self.conn, self.data_type, self.ids[0], key)
+        else:
+            store = LocalFileStore(key)
+        return CheckpointJournal(store)
+
+    def commitPages(self, writer, force=False):
+        """
+        Record the pages whose saves have all completed in the journal.
+        Pages are committed in order only: a page skips the logical
+        channels renamed with the images of the previous pages, so it is
+        complete only once those are saved too.
+        """
+        while len(self.pending_pages) > 0:
+            sequence, first, last, scope = self.pending_pages[0]
+            if writer is not None and sequence > writer.savedThrough():
+                break
+            self.pending_pages.pop(0)
+            self.checkpoint.add(first, last, scope)
+        self.checkpoint.save(force)
+
+    def recordPage(self, writer, first, last, scope=None):
+        """
+        Queue the page of IDs from first to last for the journal, to be
+        committed once the saves submitted so far have completed.
+        """
+        if self.checkpoint is None:
+            return
+        sequence = None
+        if writer is not None:
+            sequence = writer.submitted
+        self.pending_pages.append((sequence, first, last, scope))
+        self.commitPages(writer)
+
+    def resetDone(self):
+        """
+        Forget the processed IDs once no later page can contain them.
+        """
+        self.processed_images += len(self.done_image_ids)
+        self.done_lc_ids = IdSet()
+        self.done_image_ids = IdSet()
+
+    def getImageIds(self, lc_ids):
+        """
+        Return IDs of the images using any of the logical channels which
+        have not been processed yet.
+        """
+        params = omero.sys.ParametersI()
+        params.addIds(lc_ids)
+        image_ids = self.query_service.projection(
+            self.image_ids_query, params)
+        return self.done_image_ids.missing(
+            [image_id[0].getValue() for image_id in image_ids])
+
+    def getImages(self, image_ids):
+        params = omero.sys.ParametersI()
+        params.addIds(image_ids)
+        return self.query_service.findAllByQuery(
+            self.get_image_query, params)
+
+    def getChannelRows(self, image_ids):
+        params = omero.sys.ParametersI()
+        params.addIds(image_ids)
+        return self.query_service.projection(self.channel_query, params)
+
+    def saveBatch(self, objects):
+        """
+        Save objects directly or hand them to the writer pool when
+        running pipelined.
+        """
+        if len(objects) == 0:
+            return
+        if self.writer is None:
+            save_in_batches(self.update_service, objects, self.save_paging)
+        else:
+            self.writer.put(objects)
 
     def updateImageNames(self, image_list):
-        image_list = self.update_service.saveAndReturnArray(image_list)
+        self.saveBatch(image_list)
 
-    def removeLCsFromList(self, image, lc_ids_list):
-        image_noc = image.getPrimaryPixels().getSizeC().getValue()
-        for c in range(image_noc):
-            lc_id = image.getPrimaryPixels().getChannel(c). \
-                getLogicalChannel().getId().getValue()
-            lc_ids_list.remove(lc_id)
-        return lc_ids_list
+    def markDone(self, image):
+        self.done_image_ids.add(image.getId().getValue())
+        for channel in image.getPrimaryPixels().copyChannels():
+            self.done_lc_ids.add(
+                channel.getLogicalChannel().getId().getValue())
 
     def renameLCs(self, image):
         number_of_channels = len(self.new_channel_names)
@@ -136,71 +346,166 @@ class renameChannels:
             image.getPrimaryPixels().getChannel(c).getLogicalChannel().setName(
                 rstring(self.new_channel_names[c]))
 
-    def renameBatch(self, lc_ids, step):
-        lc_ids_batch = random.sample(lc_ids, step)
-        params = omero.sys.ParametersI()
-        params.addIds(lc_ids_batch)
+    def renameBatch(self, lc_ids):
+        """
+        Rename every not yet processed image using any of the logical
+        channels from lc_ids. Each image is fetched and saved once.
+        """
         number_of_channels = len(self.new_channel_names)
-        paging = self.image_paging
-        counter = 0
-        while len(lc_ids_batch) > 0:
-            params.page(counter * paging, paging)
-            counter += 1
-            image_list = self.query_service.findAllByQuery(
-                self.get_image_query, params)
+        image_ids = self.getImageIds(lc_ids)
+        for image_ids_chunk, image_list in run_in_batches(
+                self.getImages, image_ids, self.image_paging):
             print "Retrived %i images" % len(image_list)
+            to_save = []
             for image in image_list:
-                check_lc = image.getPrimaryPixels().getChannel(0). \
-                    getLogicalChannel().getId().getValue()
-                if check_lc not in lc_ids:
-                    self.updateImageNames(image_list)
-                    return
+                self.markDone(image)
                 print "Renaming", image.getName().getValue(), \
                     image.getId().getValue()
                 image_noc = image.getPrimaryPixels().getSizeC().getValue()
                 if image_noc != number_of_channels:
                     print "\tChannels don't match, skipping"
-                    lc_ids = self.removeLCsFromList(image, lc_ids)
-                    lc_ids_batch = self.removeLCsFromList(image, lc_ids_batch)
                     continue
                 self.renameLCs(image)
-                lc_ids = self.removeLCsFromList(image, lc_ids)
-                lc_ids_batch = self.removeLCsFromList(image, lc_ids_batch)
-            self.updateImageNames(image_list)
-
-    def renameImages(self, lc_ids):
-        step = self.lc_paging
-        print "Got %i unique logical channels" % len(lc_ids)
-        while len(lc_ids) > 0:
-            if len(lc_ids) < 100:
-                step = len(lc_ids)
-            self.renameBatch(lc_ids, step)
-            print "\n%i unique logical channels remains" % len(lc_ids)
-
-    def getQuery(self):
-        if self.data_type == "Screen":
-            return self.screen_query
-        elif self.data_type == "Plate":
-            return self.plate_query
-        elif self.data_type == "Well":
-            return self.well_query
-        elif self.data_type == "Project":
-            return self.project_query
-        elif self.data_type == "Dataset":
-            return self.dataset_query
-        elif self.data_type == "Image":
-            return self.image_query
+                to_save.append(image)
+            self.updateImageNames(to_save)
+
+    def updateLCNames(self, lc_names):
+        """
+        Load only the LogicalChannel rows, set their names and save them.
+        @param lc_names: map(lc_id, new_name)
+        """
+        if len(lc_names) == 0:
+            return
+        params = omero.sys.ParametersI()
+        params.addIds(lc_names.keys())
+        lc_list = self.query_service.findAllByQuery(
+            self.get_lc_query, params)
+        for lc in lc_list:
+            lc.setName(rstring(lc_names[lc.getId().getValue()]))
+        self.saveBatch(lc_list)
+
+    def renameBatchProjection(self, lc_ids):
+        """
+        Same as renameBatch but without loading the image graph. Only
+        (image ID, logical channel ID, channel index, sizeC, name) tuples
+        are projected and only the logical channels whose name changes are
+        sent back.
+        """
+        number_of_channels = len(self.new_channel_names)
+        image_ids = self.getImageIds(lc_ids)
+        for image_ids_chunk, rows in run_in_batches(
+                self.getChannelRows, image_ids, self.image_paging):
+            lc_names = {}
+            skipped = set()
+            for row in rows:
+                image_id, lc_id, index, size_c, name = unwrap(row)
+                self.done_image_ids.add(image_id)
+                self.done_lc_ids.add(lc_id)
+                if size_c != number_of_channels:
+                    skipped.add(image_id)
+                    continue
+                if name != self.new_channel_names[index]:
+                    lc_names[lc_id] = self.new_channel_names[index]
+            for image_id in skipped:
+                print "Image %i: channels don't match, skipping" % image_id
+            print "Renaming %i logical channels" % len(lc_names)
+            self.updateLCNames(lc_names)
+
+    def renameImages(self):
+        """
+        Rename the channels below the objects to rename. With concurrency
+        above 1 this thread only reads and the saves run in a
+        pipelinedWriter.
+        Completed pages are recorded in the checkpoint journal and skipped
+        when a run with the same parameters is resumed.
+        """
+        if self.rename_mode == "Full Graph":
+            renameBatch = self.renameBatch
         else:
-            print ""
+            renameBatch = self.renameBatchProjection
+        if self.concurrency > 1:
+            self.writer = pipelinedWriter(
+                self.conn.c, self.concurrency, self.stats)
+        writer = self.writer
+        try:
+            if self.data_type in ("Screen", "Plate"):
+                self.renameByWells(renameBatch, writer)
+            else:
+                self.renameByLcs(renameBatch, writer)
+        finally:
+            if writer is not None:
+                self.writer = None
+                writer.close()
+            if self.checkpoint is not None:
+                self.commitPages(writer, True)
+        if writer is not None:
+            writer.check()
+        self.resetDone()
+
+    def renameByLcs(self, renameBatch, writer):
+        """
+        Walk the logical channels below the objects to rename in ascending
+        ID order, one page of self.lc_paging IDs at a time, journalling
+        logical channel ID ranges.
+        """
+        start = 0
+        if self.checkpoint is not None:
+            start = self.checkpoint.resume_point()
+            if start > 0:
+                print "Resuming after logical channel ID %i" % start
+        previous_id = start
+        for lc_ids in self.iterLcIdPages(start):
+            last_id = lc_ids[-1]
+            lc_ids = self.done_lc_ids.missing(lc_ids)
+            if len(lc_ids) > 0:
+                renameBatch(lc_ids)
+            print "\n%i logical channels processed, last ID %i" % (
+                len(self.done_lc_ids), last_id)
+            self.recordPage(writer, previous_id + 1, last_id)
+            previous_id = last_id
+
+    def renameByWells(self, renameBatch, writer):
+        """
+        Expand screens and plates in stages rather than in one query
+        joining down to the logical channels: plates first, then the wells
+        of each plate one page of self.well_paging IDs at a time, then the
+        logical channels of those wells. Renaming starts after the first
+        page and, as an image belongs to a single well, the processed IDs
+        are forgotten after every page so memory stays flat. Well ID
+        ranges are journalled per plate.
+        """
+        extra_where, params = self.candidateFilter()
+        for plate_id in self.getPlateIds():
+            start = 0
+            if self.checkpoint is not None:
+                start = self.checkpoint.resume_point(plate_id)
+                if start > 0:
+                    print "Plate %i: resuming after well ID %i" % (
+                        plate_id, start)
+            previous_id = start
+            for well_ids in self.iterWellIdPages(plate_id, start):
+                for lc_ids in self.resolver.iter_ids(
+                        "Well", well_ids, "LogicalChannel", extra_where,
+                        params, chunk_size=self.lc_paging):
+                    lc_ids = self.done_lc_ids.missing(lc_ids)
+                    if len(lc_ids) > 0:
+                        renameBatch(lc_ids)
+                last_id = well_ids[-1]
+                print "\nPlate %i: %i images processed, last well ID %i" % (
+                    plate_id, len(self.done_image_ids), last_id)
+                self.resetDone()
+                self.recordPage(writer, previous_id + 1, last_id, plate_id)
+                previous_id = last_id
 
     def run(self):
-        query = self.getQuery()
-        if query == "":
+        if not self.resolver.supports(self.data_type, "LogicalChannel"):
             return "Object type not supported."
-        lc_ids = self.getLcIdsList(query)
-        if lc_ids is None:
+        self.checkpoint = self.openCheckpoint()
+        self.renameImages()
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+        if self.processed_images == 0:
             return "No images to rename."
-        self.renameImages(lc_ids)
         return "Done"
 
 
@@ -214,6 +519,11 @@ def runAsScript():
         rstring('Project'), rstring('Dataset'), rstring('Image'),
         rstring('Well'), rstring('Plate'), rstring('Screen')]
 
+    renameModes = [rstring('Projection'), rstring('Full Graph')]
+
+    checkpointModes = [
+        rstring('None'), rstring('Local File'), rstring('File Annotation')]
+
     client = scripts.client(
         'Change_Channel_Names.py',
         """Rename channel Names for a given object.""",
@@ -233,6 +543,29 @@ def runAsScript():
             description="Comma separated list of the new Channel Names"
         ).ofType(rstring(",")),
 
+        scripts.String(
+            "Rename_Mode", grouping="4",
+            description="Projection loads and saves only the logical"
+            " channels, Full Graph loads and saves whole images",
+            values=renameModes, default="Projection"),
+
+        scripts.Int(
+            "Concurrency", grouping="5",
+            description="Number of concurrent writer sessions, with 1"
+            " everything is saved serially",
+            default=1, min=1, max=16),
+
+        scripts.Bool(
+            "Collect_Stats", grouping="6", default=False,
+            description="Report the server calls made in a Stats output"),
+
+        scripts.String(
+            "Checkpoint", grouping="7",
+            description="Where to record progress, so that a rerun with"
+            " the same parameters resumes where an interrupted one stopped."
+            " Local journals expire after a day",
+            values=checkpointModes, default="None"),
+
         version="0.1",
         authors=["Emil Rozbicki"],
         institutions=["Glencoe Software Inc."],
@@ -247,10 +580,13 @@ def runAsScript():
                 scriptParams[key] = client.getInput(key, unwrap=True)
 
         # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
         conn = BlitzGateway(client_obj=client)
         nameChanger = renameChannels(conn, scriptParams)
         message = nameChanger.run()
         client.setOutput("Message", rstring(message))
+        if nameChanger.stats is not None:
+            client.setOutput("Stats", rstring(nameChanger.stats.summary()))
 
     finally:
         client.closeSession()
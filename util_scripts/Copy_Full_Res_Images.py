@@ -21,9 +21,13 @@
 """
 
 import omero
-from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, rlong
+from omero.rtypes import rlist, rstring
 import omero.scripts as scripts
+from script_utils.batching import AdaptiveBatchSize, save_in_batches
+from script_utils.hierarchy import HierarchyResolver
+from script_utils.idset import IdSet
+from script_utils.paging import iter_projection
+from script_utils.stats import RpcStats
 
 import re
 
@@ -44,38 +48,44 @@ class copyHighResImages:
         self.conn = conn
         self.target_project_id = scriptParams["Project_ID"]
         self.source_datasets_list = scriptParams["IDs"]
-        self.image_dict = self.getImageList()
-        self.target_dataset_names = self.getTargetDatasetNames()
         self.query_service = self.conn.getQueryService()
         self.update_service = self.conn.getUpdateService()
-        self.dataset_query = \
-            "select d from Project as p" \
-            " left outer join p.datasetLinks as links" \
-            " left outer join links.child as d" \
-            " left outer join fetch d.imageLinks as i_link" \
-            " left outer join fetch i_link.child" \
-            " where p.id = :pid and d.name = :dname"
+        self.stats = None
+        if scriptParams.get("Collect_Stats"):
+            self.stats = RpcStats()
+            self.query_service = self.stats.wrap(self.query_service, "query")
+            self.update_service = self.stats.wrap(
+                self.update_service, "update")
+        self.image_paging = 1000
+        self.link_read_paging = AdaptiveBatchSize(1000, 10, 10000)
+        self.link_save_paging = AdaptiveBatchSize(1000, 10, 1000)
+        self.resolver = HierarchyResolver(self.query_service)
+        self.image_link_query = \
+            "select l.id, l.parent.id, l.child.id" \
+            " from DatasetImageLink as l" \
+            " where l.parent.id in (:ids) and l.id > :last" \
+            " order by l.id"
 
-    def getImageList(self):
+    def iterImages(self):
         """
-        Retrive images from the source datasets.
+        Stream images from the source datasets as (image_id, dataset_name)
+        pairs, skipping the ones whose name does not match the regex. Only
+        image IDs and names are projected, one page at a time.
         """
-
-        image_dict = {}
-        for datasetId in self.source_datasets_list:
-            dataset = conn.getObject("Dataset", datasetId)
-            for image in dataset.listChildren():
-                if "[" in image.getName():
+        for rows in self.resolver.iter_rows(
+                "Dataset", self.source_datasets_list, "Image",
+                ["dil.child.name"], chunk_size=self.image_paging):
+            for image_id, image_name in rows:
+                if "[" in image_name:
                     continue
-                file_name = self.FILENAME_REGEX.match(image.getName())
+                file_name = self.FILENAME_REGEX.match(image_name)
                 if file_name is None:
                     continue
-                image_dict[image.getId()] = file_name.group(1)
-        return image_dict
+                yield image_id, file_name.group(1)
 
     def printImageList(self):
-        for image in self.image_dict:
-            print image, self.image_dict[image]
+        for image_id, dataset_name in self.iterImages():
+            print image_id, dataset_name
 
     def getTargetDatasetNames(self):
         """
@@ -83,66 +93,118 @@ class copyHighResImages:
         list.
         """
         dataset_names = set()
-        for image in self.image_dict:
-            dataset_names.add(self.image_dict[image])
+        for image_id, dataset_name in self.iterImages():
+            dataset_names.add(dataset_name)
         return dataset_names
 
-    def getDatasetMap(self):
+    def findDatasets(self, names):
         """
-        Convert unique list of dataset names to a map
-        (dataset_name, dataset_object).
+        Find the datasets with the given names in the target project with
+        a single query. If several datasets share a name the oldest one is
+        used.
+
+        @param names: dataset names
         """
         dataset_map = {}
+        if len(names) == 0:
+            return dataset_map
         params = omero.sys.ParametersI()
-        params.add("pid", rlong(self.target_project_id))
-        for name in self.target_dataset_names:
-            params.add("dname", rstring(name))
-            dataset = self.query_service.findByQuery(
-                self.dataset_query, params)
-            if dataset is None:
-                print "Creating new datset"
-                dataset = omero.model.DatasetI()
-                dataset.setName(rstring(name))
-                dataset = \
-                    self.update_service.saveAndReturnObject(dataset)
-                datasetId = dataset.getId().getValue()
-                print "\tNew dataset ID:", datasetId
-                link = omero.model.ProjectDatasetLinkI()
-                print "\tLinking dataset to:", self.target_project_id
-                link.parent = omero.model.ProjectI(
-                    self.target_project_id, False)
-                link.child = omero.model.DatasetI(datasetId, False)
-                self.update_service.saveObject(link)
-                dataset = self.query_service.findByQuery(
-                    self.dataset_query, params)
-            dataset_map[name] = dataset
+        params.add("names", rlist([rstring(name) for name in names]))
+        for rows in self.resolver.iter_rows(
+                "Project", [self.target_project_id], "Dataset",
+                ["pdl.child.name"], "pdl.child.name in (:names)", params):
+            for dataset_id, name in rows:
+                if name not in dataset_map:
+                    dataset_map[name] = dataset_id
         return dataset_map
 
-    def saveImagesToServer(self, dataset_dict):
+    def createDatasets(self, names):
         """
-        Convert dataset hash map to list and save linked images to the server.
+        Create the datasets and link them to the target project with a
+        single array save and return a map (dataset_name, dataset_id).
 
-        @param dataset_dict: map(dataset_name, dataset_object)
+        @param names: dataset names
         """
-        dataset_list = []
-        for dataset_name in dataset_dict:
-            dataset_list.append(dataset_dict[dataset_name])
-        self.update_service.saveAndReturnArray(dataset_list)
+        links = []
+        for name in names:
+            print "Creating new dataset:", name
+            dataset = omero.model.DatasetI()
+            dataset.setName(rstring(name))
+            link = omero.model.ProjectDatasetLinkI()
+            link.parent = omero.model.ProjectI(
+                self.target_project_id, False)
+            link.child = dataset
+            links.append(link)
+        print "\tLinking %i datasets to: %s" % (
+            len(links), self.target_project_id)
+        links = self.update_service.saveAndReturnArray(links)
+        dataset_map = {}
+        for link in links:
+            dataset_map[link.child.name.val] = link.child.id.val
+        return dataset_map
+
+    def getDatasetMap(self):
+        """
+        Convert unique list of dataset names to a map
+        (dataset_name, dataset_id).
+        """
+        dataset_names = self.getTargetDatasetNames()
+        dataset_map = self.findDatasets(dataset_names)
+        missing = [name for name in dataset_names
+                   if name not in dataset_map]
+        if len(missing) > 0:
+            dataset_map.update(self.createDatasets(missing))
+        return dataset_map
+
+    def getLinkedImages(self, dataset_ids):
+        """
+        Return a map (dataset_id, IdSet of image IDs) of the images already
+        linked in the target datasets, read page by page from a projection.
+
+        @param dataset_ids: target dataset IDs
+        """
+        linked = {}
+        for dataset_id in dataset_ids:
+            linked[dataset_id] = IdSet()
+        if len(dataset_ids) == 0:
+            return linked
+        params = omero.sys.ParametersI()
+        params.addIds(dataset_ids)
+        for rows in iter_projection(
+                self.query_service, self.image_link_query, params,
+                self.link_read_paging):
+            for link_id, dataset_id, image_id in rows:
+                linked[dataset_id].add(image_id)
+        return linked
+
+    def saveLinks(self, links):
+        if len(links) > 0:
+            save_in_batches(
+                self.update_service, links, self.link_save_paging)
 
     def copyImages(self):
         """
-        Link images to the target datasets.
+        Link images to the target datasets. Only the missing
+        DatasetImageLinks are created, in chunks of self.link_save_paging
+        which adapts to the time the saves take.
         """
-        dataset_dict = self.getDatasetMap()
-        for image_id in self.image_dict:
-            dataset_target = dataset_dict[self.image_dict[image_id]]
-            image_ids = [
-                v.id.val for v in dataset_target.linkedImageList()]
-            if image_id in image_ids:
+        dataset_map = self.getDatasetMap()
+        linked = self.getLinkedImages(dataset_map.values())
+        links = []
+        for image_id, dataset_name in self.iterImages():
+            dataset_id = dataset_map.get(dataset_name)
+            if dataset_id is None or image_id in linked[dataset_id]:
                 continue
-            print "Copying image:", image_id, self.image_dict[image_id]
-            dataset_target.linkImage(omero.model.ImageI(image_id, False))
-        self.saveImagesToServer(dataset_dict)
+            linked[dataset_id].add(image_id)
+            print "Copying image:", image_id, dataset_name
+            link = omero.model.DatasetImageLinkI()
+            link.parent = omero.model.DatasetI(dataset_id, False)
+            link.child = omero.model.ImageI(image_id, False)
+            links.append(link)
+            if len(links) >= self.link_save_paging.size:
+                self.saveLinks(links)
+                links = []
+        self.saveLinks(links)
 
     def run(self):
         """
@@ -178,6 +240,10 @@ if __name__ == "__main__":
             description="New dataset name will be based on the image name \
             formated by regex", default="^(\w+-\w+)-.*"),
 
+        scripts.Bool(
+            "Collect_Stats", grouping="5", default=False,
+            description="Report the server calls made in a Stats output"),
+
         version="0.1",
         authors=["Emil Rozbicki"],
         institutions=["Glencoe Software Inc."],
@@ -191,9 +257,12 @@ if __name__ == "__main__":
             if client.getInput(key):
                 scriptParams[key] = client.getInput(key, unwrap=True)
         # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
         conn = BlitzGateway(client_obj=client)
         processImages = copyHighResImages(conn, scriptParams)
         message = processImages.run()
         client.setOutput("Message", rstring(message))
+        if processImages.stats is not None:
+            client.setOutput("Stats", rstring(processImages.stats.summary()))
     finally:
         client.closeSession()
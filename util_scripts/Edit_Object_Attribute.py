@@ -26,39 +26,278 @@ import omero
 import omero.clients
 assert omero
 
-from omero.rtypes import rstring, rtype, rtime, rdouble
+from omero.rtypes import rlong, rstring, rtype, rtime, rdouble, unwrap
+
+from omero.sys import ParametersI
 
 import omero.scripts as scripts
 
+from script_utils.batching import AdaptiveBatchSize
+from script_utils.batching import run_in_batches, save_in_batches
+from script_utils.stats import RpcStats
+
+import csv
+import re
+
+from cStringIO import StringIO
+
+# Number of objects loaded per query in batch mode
+CHUNK_SIZE = 500
+
+DATA_TYPE_REGEX = re.compile(r'^[A-Za-z]+$')
+
+ATTRIBUTE_REGEX = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+# Context of the queries, which look in all the groups
+ALL_GROUPS = {'omero.group': '-1'}
+
+# Types of the values, see convert_value
+ATTRIBUTE_TYPES = ['Bool', 'Double', 'Float', 'Int', 'Long', 'Time', 'String']
+
+
+def convert_value(attribute_type, value):
+    '''
+    Wrap value in the rtype matching attribute_type.
+    '''
+    if attribute_type == 'Bool':
+        return rtype(bool(value))
+    elif attribute_type == 'Double':
+        return rdouble(float(value))
+    elif attribute_type == 'Float':
+        return rtype(float(value))
+    elif attribute_type == 'Int':
+        return rtype(int(value))
+    elif attribute_type == 'Long':
+        return rtype(long(value))
+    elif attribute_type == 'Time':
+        return rtime(long(value))
+    return rtype(value)
+
+
+def read_edits(session, file_id):
+    '''
+    Read the type,id,attribute,value[,attribute_type] rows of a CSV
+    OriginalFile as (type, id, attribute, value, attribute_type) tuples,
+    attribute_type being None when the column is missing or empty.
+    A header row, as the first row, and rows starting with # are skipped.
+    Any other row which is not a valid edit raises ValueError.
+    '''
+    store = session.createRawFileStore()
+    try:
+        store.setFileId(file_id, ALL_GROUPS)
+        data = store.read(0, store.size())
+    finally:
+        store.close()
+    edits = []
+    for line, row in enumerate(csv.reader(StringIO(data))):
+        if not row or row[0].strip().startswith('#'):
+            continue
+        if len(row) not in (4, 5):
+            raise ValueError(
+                'Line %d: expected type,id,attribute,value[,attribute_type]:'
+                ' %r' % (line + 1, row))
+        row = [column.strip() for column in row]
+        if not row[1].isdigit():
+            if line == 0:
+                # Header
+                continue
+            raise ValueError('Line %d: invalid ID: %r' % (line + 1, row[1]))
+        if len(row) == 4 or not row[4]:
+            row[4:] = [None]
+        elif row[4] not in ATTRIBUTE_TYPES:
+            raise ValueError('Line %d: invalid attribute type: %r' % (
+                line + 1, row[4]))
+        edits.append(tuple(row))
+    return edits
+
+
+def split_attribute(attribute):
+    '''
+    Split a possibly nested attribute, e.g. pixels.physicalSizeX, into
+    the tuple of the properties leading to the target object and the
+    attribute to set on it.
+    '''
+    names = attribute.split('.')
+    for name in names:
+        if not ATTRIBUTE_REGEX.match(name):
+            raise ValueError('Invalid attribute: %s' % attribute)
+    return tuple(names[:-1]), names[-1]
+
+
+def target_query(data_type, path, select, where):
+    '''
+    HQL joining the objects of data_type, aliased o, along path to their
+    target objects, aliased t.
+    '''
+    joins = []
+    alias = 'o'
+    for index, name in enumerate(path):
+        target = 'j%d' % index
+        if index == len(path) - 1:
+            target = 't'
+        joins.append('join %s.%s as %s' % (alias, name, target))
+        alias = target
+    return 'select %s from %s as o %s where %s' % (
+        select, data_type, ' '.join(joins), where)
+
+
+def edit_objects(query_service, update_service, edits, attribute_type,
+                 chunk_size=CHUNK_SIZE):
+    '''
+    Apply a list of (data_type, id, attribute, value, value_type) edits,
+    values being converted to their value_type, or to attribute_type when
+    it is None. The attribute may be a path to a related object, e.g.
+    pixels.physicalSizeX on an Image; only that object is loaded and saved
+    then.
+
+    Objects are handled per type and attribute path, one chunk of IDs at a
+    time. Top level attributes take one query per chunk loading the
+    objects. Nested ones take one projection resolving the IDs and groups
+    of the targets and one query loading only the targets. Objects are
+    saved with one saveArray per group, the group contexts being shared by
+    all the chunks. Chunks start at chunk_size and adapt to the time the
+    calls take.
+
+    Returns the number of objects saved and the sorted (data type, ID)
+    pairs of the objects which could not be found or read, or which have
+    no object at the end of the attribute path. Those are not edited.
+    '''
+    by_path = {}
+    for data_type, object_id, attribute, value, value_type in edits:
+        if not DATA_TYPE_REGEX.match(data_type):
+            raise ValueError('Invalid data type: %s' % data_type)
+        path, attribute = split_attribute(attribute)
+        by_id = by_path.setdefault((data_type, path), {})
+        by_id.setdefault(long(object_id), []).append(
+            (attribute, convert_value(value_type or attribute_type, value)))
+
+    read_size = AdaptiveBatchSize(chunk_size, 10, 10 * chunk_size)
+    save_size = AdaptiveBatchSize(chunk_size, 1, 10 * chunk_size)
+    contexts = {}
+    count = 0
+    missing = []
+    for (data_type, path), by_id in by_path.items():
+
+        def load(ids):
+            '''
+            Load the targets of the objects with the given IDs, returning
+            (target, attribute edits, group ID) tuples.
+            '''
+            params = ParametersI()
+            params.addIds(ids)
+            if not path:
+                objects = query_service.findAllByQuery(
+                    'select o from %s as o where o.id in (:ids)' % data_type,
+                    params, ALL_GROUPS)
+                found = set([o.id.val for o in objects])
+                missing.extend([(data_type, object_id) for object_id in ids
+                                if object_id not in found])
+                targets = []
+                for o in objects:
+                    try:
+                        group_id = o.details.group.id.val
+                    except AttributeError:
+                        group_id = None
+                    targets.append((o, by_id[o.id.val], group_id))
+                return targets
+            rows = query_service.projection(
+                target_query(data_type, path,
+                             'o.id, t.id, t.details.group.id',
+                             'o.id in (:ids)'),
+                params, ALL_GROUPS)
+            target_edits = {}
+            target_groups = {}
+            target_owners = {}
+            for object_id, target_id, group_id in unwrap(rows):
+                target_edits.setdefault(target_id, []).extend(
+                    by_id[object_id])
+                target_groups[target_id] = group_id
+                target_owners.setdefault(target_id, []).append(object_id)
+            owners = set()
+            for owner_ids in target_owners.values():
+                owners.update(owner_ids)
+            missing.extend([(data_type, object_id) for object_id in ids
+                            if object_id not in owners])
+            if not target_edits:
+                return []
+            params = ParametersI()
+            params.addIds(target_edits.keys())
+            objects = query_service.findAllByQuery(
+                target_query(data_type, path, 'distinct t',
+                             't.id in (:ids)'),
+                params, ALL_GROUPS)
+            found = set([o.id.val for o in objects])
+            for target_id, owner_ids in target_owners.items():
+                if target_id not in found:
+                    missing.extend([(data_type, object_id)
+                                    for object_id in owner_ids])
+            return [(o, target_edits[o.id.val], target_groups[o.id.val])
+                    for o in objects]
+
+        done = 0
+        name = '.'.join((data_type,) + path)
+        for ids, targets in run_in_batches(
+                load, sorted(by_id.keys()), read_size):
+            by_group = {}
+            for o, attribute_edits, group_id in targets:
+                for attribute, value in attribute_edits:
+                    setattr(o, attribute, value)
+                by_group.setdefault(group_id, []).append(o)
+            for group_id, group_objects in by_group.items():
+                ctx = None
+                if group_id is not None:
+                    if group_id not in contexts:
+                        contexts[group_id] = {'omero.group': str(group_id)}
+                    ctx = contexts[group_id]
+                save_in_batches(update_service, group_objects, save_size, ctx)
+                count += len(group_objects)
+            done += len(ids)
+            print '%s: %d of %d object(s) processed' % (
+                name, done, len(by_id))
+    return count, sorted(set(missing))
+
 
 def run():
     '''
     '''
     client = scripts.client(
         'Edit_Object_Attribute.py',
-        'Edit the attributes of an object',
+        'Edit the attributes of an object, a list of objects or the objects'
+        ' listed in a type,id,attribute,value[,attribute_type] CSV file',
 
-        scripts.String('Data_Type', optional=False, grouping='1',
+        scripts.String('Data_Type', optional=True, grouping='1',
                        description='The data type you want to work with.'),
 
-        scripts.Long('ID', optional=False, grouping='2',
+        scripts.Long('ID', optional=True, grouping='2',
                      description='Object ID'),
 
-        scripts.String('Attribute', optional=False, grouping='3',
-                       description='Attribute to set'),
+        scripts.String('Attribute', optional=True, grouping='3',
+                       description='Attribute to set, may be a path to a'
+                       ' related object, e.g. pixels.physicalSizeX'),
 
         scripts.String('Attribute_Type', optional=False, grouping='4',
-                       description='Type of the attribute to set',
-                       values=[
-                           rstring('Bool'), rstring('Double'),
-                           rstring('Float'), rstring('Int'),
-                           rstring('Long'), rstring('Time'),
-                           rstring('String')
-                       ], default='String'),
-
-        scripts.String('Value', optional=False, grouping='5',
+                       description='Type of the attribute to set, the'
+                       ' default of the rows of a CSV without their own',
+                       values=[rstring(attribute_type)
+                               for attribute_type in ATTRIBUTE_TYPES],
+                       default='String'),
+
+        scripts.String('Value', optional=True, grouping='5',
                        description='Value to set'),
 
+        scripts.List('IDs', optional=True, grouping='6',
+                     description='Object IDs, edited in batch'
+                     ).ofType(rlong(0)),
+
+        scripts.Long('File_ID', optional=True, grouping='7',
+                     description='OriginalFile ID of a CSV with'
+                     ' type,id,attribute,value[,attribute_type] rows,'
+                     ' edited in batch'),
+
+        scripts.Bool('Collect_Stats', grouping='8', default=False,
+                     description='Report the server calls made in a Stats'
+                                 ' output'),
+
         version='0.1',
         authors=['Chris Allan'],
         institutions=['Glencoe Software Inc.'],
@@ -74,36 +313,52 @@ def run():
         session = client.getSession()
         update_service = session.getUpdateService()
         query_service = session.getQueryService()
+        stats = None
+        if script_params.get('Collect_Stats'):
+            stats = RpcStats()
+            update_service = stats.wrap(update_service, 'update')
+            query_service = stats.wrap(query_service, 'query')
+
+        if 'File_ID' in script_params:
+            try:
+                edits = read_edits(session, script_params['File_ID'])
+            except ValueError as e:
+                client.setOutput('Message', rstring('ERROR: %s' % e))
+                return
+        else:
+            ids = script_params.get('IDs', [])
+            if 'ID' in script_params:
+                ids = [script_params['ID']] + list(ids)
+            for key in ('Data_Type', 'Attribute', 'Value'):
+                if key not in script_params:
+                    client.setOutput('Message', rstring(
+                        'ERROR: %s is required without File_ID' % key))
+                    return
+            edits = [(script_params['Data_Type'], object_id,
+                      script_params['Attribute'], script_params['Value'],
+                      None) for object_id in ids]
+        if not edits:
+            client.setOutput('Message', rstring(
+                'ERROR: No objects to edit, set ID, IDs or File_ID'))
+            return
+
+        count, missing = edit_objects(
+            query_service, update_service, edits,
+            script_params['Attribute_Type'])
 
-        value = script_params['Value']
-        if script_params['Attribute_Type'] == 'Bool':
-            value = rtype(bool(value))
-        elif script_params['Attribute_Type'] == 'Double':
-            value = rdouble(float(value))
-        elif script_params['Attribute_Type'] == 'Float':
-            value = rtype(float(value))
-        elif script_params['Attribute_Type'] == 'Int':
-            value = rtype(int(value))
-        elif script_params['Attribute_Type'] == 'Long':
-            value = rtype(long(value))
-        elif script_params['Attribute_Type'] == 'Time':
-            value = rtime(long(value))
+        if missing:
+            client.setOutput('Message', rstring(
+                'ERROR: %d object(s) not found or not readable, not'
+                ' edited: %s. Attribute set on %d object(s).' % (
+                    len(missing),
+                    ', '.join(['%s:%d' % pair for pair in missing]),
+                    count)))
         else:
-            value = rtype(value)
-
-        ctx = {'omero.group': '-1'}
-        o = query_service.get(
-            script_params['Data_Type'], script_params['ID'], ctx)
-        setattr(o, script_params['Attribute'], value)
-        ctx = None
-        try:
-            ctx = {'omero.group': str(o.details.group.id.val)}
-        except AttributeError:
-            pass
-        update_service.saveObject(o, ctx)
-
-        client.setOutput('Message', rstring(
-            'Setting of attribute successful.'))
+            client.setOutput('Message', rstring(
+                'Setting of attribute successful on %d object(s).' %
+                count))
+        if stats is not None:
+            client.setOutput('Stats', rstring(stats.summary()))
     finally:
         client.closeSession()
 
@@ -23,58 +23,286 @@ Populate metadata from CSV.
 '''
 
 import omero
-from omero.gateway import BlitzGateway
-from omero.rtypes import rstring
+from omero.rtypes import rlong, rstring
 import omero.scripts as scripts
 from omero.model import PlateI, ScreenI
 
+import Queue
+import csv
+import json
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 
-from omero.util.populate_roi import DownloadingOriginalFileProvider
-from omero.util.populate_metadata import ParsingContext
+# Bytes read from the RawFileStore per call
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Downloads larger than this are spooled to disk
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+# Per Plate CSV files kept open while splitting a Screen CSV
+MAX_OPEN_FILES = 64
+# Argument running the script as a populate_plate worker
+WORKER_ARG = "--populate-plate-worker"
 
 
 def get_original_file(conn, object_type, object_id, file_id):
-    if object_type == "Plate":
-        omero_object = conn.getObject("Plate", int(object_id))
-        if omero_object is None:
-            sys.stderr.write("Error: Plate does not exist.\n")
-            sys.exit(1)
-    else:
-        omero_object = conn.getObject("Screen", int(object_id))
-        if omero_object is None:
-            sys.stderr.write("Error: Screen does not exist.\n")
-            sys.exit(1)
-    file = None
-    for ann in omero_object.listAnnotations():
-        if isinstance(ann, omero.gateway.FileAnnotationWrapper):
-            print "File ID:", ann.getFile().getId(), ann.getFile().getName(),\
-                "Size:", ann.getFile().getSize()
-            if (ann.getFile().getId() == int(file_id)):
-                file = ann.getFile()._obj
+    """
+    Load the OriginalFile file_id, checking with the same query that it is
+    attached to the Plate or Screen object_id through a FileAnnotation.
+    """
+    params = omero.sys.ParametersI()
+    params.add("oid", rlong(object_id))
+    params.add("fid", rlong(file_id))
+    file = conn.getQueryService().findByQuery(
+        "select distinct f from %sAnnotationLink as l,"
+        " FileAnnotation as a join a.file as f"
+        " where l.child.id = a.id and l.parent.id = :oid"
+        " and f.id = :fid" % object_type,
+        params, {"omero.group": "-1"})
     if file is None:
-        sys.stderr.write("Error: File does not exist.\n")
+        sys.stderr.write(
+            "Error: File %s is not attached to %s %s.\n" %
+            (file_id, object_type, object_id))
         sys.exit(1)
+    print "File ID:", file.getId().getValue(), \
+        file.getName().getValue(), "Size:", file.getSize().getValue()
     return file
 
 
+def download_original_file(conn, original_file):
+    """
+    Stream the content of original_file through a RawFileStore, chunk by
+    chunk, into a temporary file which is spooled to disk once it grows
+    above SPOOL_MAX_SIZE. Returns the temporary file rewound to the start.
+    """
+    file_handle = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    store = conn.createRawFileStore()
+    try:
+        store.setFileId(
+            original_file.getId().getValue(), {"omero.group": "-1"})
+        size = store.size()
+        offset = 0
+        while offset < size:
+            block = store.read(offset, min(DOWNLOAD_CHUNK_SIZE, size - offset))
+            if not block:
+                break
+            file_handle.write(block)
+            offset += len(block)
+    finally:
+        store.close()
+    file_handle.seek(0)
+    return file_handle
+
+
+def split_by_plate(file_handle, directory):
+    """
+    Split a Screen CSV into one CSV per value of its Plate column, in
+    directory, in a single pass. Every file keeps the original header row.
+    At most MAX_OPEN_FILES files are open at a time, the others are
+    reopened for appending when a row of their Plate comes.
+    Returns a map (plate_name, file_path).
+    """
+    reader = csv.reader(file_handle)
+    header = reader.next()
+    columns = [column.strip().lower() for column in header]
+    if "plate" not in columns:
+        raise ValueError("CSV has no Plate column")
+    plate_column = columns.index("plate")
+    plate_paths = {}
+    # plate_name -> (file, writer), in the order they were last used
+    open_files = {}
+    used = []
+    try:
+        for row in reader:
+            if len(row) <= plate_column:
+                continue
+            plate_name = row[plate_column].strip()
+            if plate_name in open_files:
+                used.remove(plate_name)
+            else:
+                if len(open_files) >= MAX_OPEN_FILES:
+                    open_files.pop(used.pop(0))[0].close()
+                if plate_name not in plate_paths:
+                    plate_paths[plate_name] = os.path.join(
+                        directory, "plate_%d.csv" % len(plate_paths))
+                    plate_file = open(plate_paths[plate_name], "wb")
+                    csv.writer(plate_file).writerow(header)
+                else:
+                    plate_file = open(plate_paths[plate_name], "ab")
+                open_files[plate_name] = (plate_file, csv.writer(plate_file))
+            used.append(plate_name)
+            open_files[plate_name][1].writerow(row)
+    finally:
+        for plate_file, writer in open_files.values():
+            plate_file.close()
+    return plate_paths
+
+
+def get_screen_plates(conn, screen_id):
+    """
+    Return a map (plate_name, plate_id) of the Plates in the Screen.
+    """
+    params = omero.sys.ParametersI()
+    params.addId(screen_id)
+    rows = conn.getQueryService().projection(
+        "select p.id, p.name from ScreenPlateLink as l"
+        " join l.child as p where l.parent.id = :id",
+        params, {"omero.group": "-1"})
+    return dict((row[1].getValue(), row[0].getValue()) for row in rows)
+
+
+def populate_plate(args):
+    """
+    Worker populating one Plate from its part of the CSV through its own
+    session joined to the script session.
+    Returns (plate_name, error_message).
+    """
+    from omero.util.populate_metadata import ParsingContext
+    properties, session_uuid, plate_name, plate_id, path = args
+    worker_client = omero.client(pmap=properties)
+    try:
+        worker_client.joinSession(session_uuid)
+        ctx = ParsingContext(worker_client, PlateI(plate_id, False), "")
+        file_handle = open(path)
+        try:
+            ctx.parse_from_handle(file_handle)
+        finally:
+            file_handle.close()
+        ctx.write_to_omero()
+        return plate_name, None
+    except Exception as e:
+        return plate_name, str(e)
+    finally:
+        worker_client.closeSession()
+
+
+def run_worker():
+    """
+    Main of a worker interpreter: populate_plate with the arguments read
+    as JSON from stdin, printing its result as JSON on the last line.
+    """
+    print json.dumps(populate_plate(json.loads(sys.stdin.read())))
+
+
+def populate_plate_process(args):
+    """
+    Run populate_plate in a fresh interpreter. The script process is not
+    forked, as Ice does not support forking a process whose communicator
+    threads are running. Returns (plate_name, error_message).
+    """
+    try:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), WORKER_ARG],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        lines = process.communicate(json.dumps(args))[0].splitlines()
+    except Exception as e:
+        return args[2], str(e)
+    for line in lines[:-1]:
+        print line
+    try:
+        plate_name, error = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return args[2], "worker exited with status %d" % process.returncode
+    return plate_name, error
+
+
+def imap_workers(function, tasks, workers):
+    """
+    Call function on each task from up to workers threads, yielding the
+    results as they complete. function must not raise.
+    """
+    queue = Queue.Queue()
+    for task in tasks:
+        queue.put(task)
+    results = Queue.Queue()
+
+    def work():
+        while True:
+            try:
+                task = queue.get_nowait()
+            except Queue.Empty:
+                return
+            results.put(function(task))
+
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(tasks)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for task in tasks:
+        yield results.get()
+    for thread in threads:
+        thread.join()
+
+
+def populate_screen_parallel(client, conn, screen_id, file_handle, workers):
+    """
+    Populate every Plate of the Screen separately, workers Plates at a time
+    each in its own interpreter, and summarise the outcome in one message.
+    """
+    directory = tempfile.mkdtemp(prefix="populate_metadata")
+    try:
+        try:
+            plate_paths = split_by_plate(file_handle, directory)
+        finally:
+            file_handle.close()
+        plates = get_screen_plates(conn, screen_id)
+        tasks = []
+        missing = []
+        for plate_name, path in plate_paths.items():
+            if plate_name not in plates:
+                missing.append(plate_name)
+                continue
+            tasks.append((client.getPropertyMap(), client.getSessionId(),
+                          plate_name, plates[plate_name], path))
+
+        failed = []
+        for plate_name, error in imap_workers(
+                populate_plate_process, tasks, workers):
+            if error is None:
+                print "Populated Plate", plate_name
+            else:
+                print "Failed Plate", plate_name, error
+                failed.append("%s (%s)" % (plate_name, error))
+    finally:
+        shutil.rmtree(directory, True)
+
+    message = "Populated %d of %d Plate(s)." % (
+        len(tasks) - len(failed), len(plate_paths))
+    if missing:
+        message += " Not in Screen: %s." % ", ".join(sorted(missing))
+    if failed:
+        message += " Failed: %s." % ", ".join(sorted(failed))
+    return message
+
+
 def populate_metadata(client, conn, script_params):
+    from omero.util.populate_metadata import ParsingContext
     object_id = long(script_params["IDs"])
     file_id = long(script_params["File_ID"])
+    workers = script_params.get("Workers", 1)
     original_file = get_original_file(
         conn, script_params["Data_Type"], object_id, file_id)
-    provider = DownloadingOriginalFileProvider(conn)
-    file_handle = provider.get_original_file_data(original_file)
+    file_handle = download_original_file(conn, original_file)
+    if script_params["Data_Type"] == "Screen" and workers > 1:
+        return populate_screen_parallel(
+            client, conn, object_id, file_handle, workers)
     if script_params["Data_Type"] == "Plate":
         omero_object = PlateI(long(object_id), False)
     else:
         omero_object = ScreenI(long(object_id), False)
     ctx = ParsingContext(client, omero_object, "")
-    ctx.parse_from_handle(file_handle)
+    try:
+        ctx.parse_from_handle(file_handle)
+    finally:
+        file_handle.close()
     ctx.write_to_omero()
+    return "Populated %s %s." % (script_params["Data_Type"], object_id)
 
 
-if __name__ == "__main__":
+def run():
     dataTypes = [rstring('Plate'), rstring('Screen')]
     client = scripts.client(
         'Populate_Metadata.py',
@@ -93,6 +321,11 @@ if __name__ == "__main__":
             "File_ID", optional=False, grouping="3", default='',
             description="File ID containing metadata to populate."),
 
+        scripts.Int(
+            "Workers", grouping="4", default=1, min=1, max=16,
+            description="Number of Plates of a Screen populated in"
+            " parallel. With 1 the Screen is populated as a whole."),
+
         version="0.2",
         authors=["Emil Rozbicki"],
         institutions=["Glencoe Software Inc."],
@@ -108,9 +341,17 @@ if __name__ == "__main__":
         print scriptParams
 
         # wrap client to use the Blitz Gateway
+        from omero.gateway import BlitzGateway
         conn = BlitzGateway(client_obj=client)
         message = populate_metadata(client, conn, scriptParams)
         client.setOutput("Message", rstring(message))
 
     finally:
         client.closeSession()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == [WORKER_ARG]:
+        run_worker()
+    else:
+        run()